@@ -0,0 +1,59 @@
+#Uniform grid spatial hash for collisions. Cells are one tile big.
+#Solid tiles are added when a level is loaded, NPCs and the player are moved in it as they move.
+
+import SETTINGS
+
+class SpatialHash:
+    '''== Solid tiles and moving bodies by grid cell ==\nquery(rect) only checks the cells the rect touches'''
+    def __init__(self):
+        self.static = {}
+        self.dynamic = {}
+        #body -> cells it is in
+        self.body_cells = {}
+
+    def cells(self, rect):
+        size = SETTINGS.tile_size
+        return [(column, row) for row in range(int(rect.top // size), int((rect.bottom - 1) // size) + 1)
+                for column in range(int(rect.left // size), int((rect.right - 1) // size) + 1)]
+
+    def build(self):
+        '''== Add the solid tiles of the current level ==\nClears everything else'''
+        self.static = {}
+        self.dynamic = {}
+        self.body_cells = {}
+        for tile in SETTINGS.all_solid_tiles:
+            for cell in self.cells(tile.rect):
+                self.static.setdefault(cell, []).append(tile)
+        if SETTINGS.player:
+            self.move(SETTINGS.player)
+
+    def move(self, body):
+        '''== Put a body in the cells of its rect =='''
+        cells = self.cells(body.rect)
+        old_cells = self.body_cells.get(body)
+        if cells == old_cells:
+            return
+        if old_cells:
+            for cell in old_cells:
+                self.dynamic[cell].remove(body)
+        for cell in cells:
+            self.dynamic.setdefault(cell, []).append(body)
+        self.body_cells[body] = cells
+
+    def query(self, rect, ignore=None):
+        '''== Everything that collides with rect ==\nquery(rect, ignore) -> solid tiles in map order, then bodies in NPC order with the player last'''
+        tiles = []
+        bodies = []
+        for cell in self.cells(rect):
+            for tile in self.static.get(cell, ()):
+                if tile not in tiles and rect.colliderect(tile):
+                    tiles.append(tile)
+            for body in self.dynamic.get(cell, ()):
+                if body is not ignore and body not in bodies and rect.colliderect(body):
+                    bodies.append(body)
+        #The old collide lists were in this order, and it decides which push wins
+        tiles.sort(key=lambda tile: (tile.map_pos[1], tile.map_pos[0]))
+        bodies.sort(key=lambda body: getattr(body, 'order', len(SETTINGS.npc_list)))
+        return tiles + bodies
+
+world = SpatialHash()
@@ -1,6 +1,11 @@
 #Level classes for DUGA
 
 import SETTINGS
+import hashlib
+
+def level_hash(array, *extra):
+    '''== Hash of a level layout ==\nlevel_hash(array, *extra) -> hex string. Used to name cache files.\nextra -> anything else the cached data depends on'''
+    return hashlib.sha1(repr((array, extra)).encode()).hexdigest()[:16]
 
 class Level:
     
@@ -21,6 +26,11 @@ class Level:
             self.name = stats['name']
         if 'author' in stats:
             self.author = stats['author']
+        #'astar', or 'jps' for big open levels where jump point search expands far fewer tiles
+        if 'pathfinding' in stats:
+            self.pathfinding = stats['pathfinding']
+        else:
+            self.pathfinding = 'astar'
 
 ##SETTINGS.levels_list.append(Level({
 ##'ground_color' : (255, 255, 255),
@@ -28,6 +28,9 @@ import ENTITIES
 import MENU
 import MUSIC
 import LASERTAG_ARENA
+import QUALITY
+import VISIBILITY
+import COLLISION
 
 pygame.init()
 pygame.font.init()
@@ -90,6 +93,7 @@ class Load:
         SETTINGS.music_volume = settings['music volume']
         SETTINGS.resolution = settings['graphics'][0]
         SETTINGS.render = settings['graphics'][1]
+        SETTINGS.draw_distance = SETTINGS.render
         SETTINGS.fullscreen = settings['fullscreen']
 
         #Load statistics
@@ -131,25 +135,33 @@ class Load:
     def load_new_level(self):    
         #Remove old level info
         SETTINGS.npc_list = []
+        PATHFINDING.path_service.clear()
         SETTINGS.all_items = []
         SETTINGS.walkable_area = []
         SETTINGS.all_tiles = []
         SETTINGS.all_doors = []
+        SETTINGS.door_grid = {}
+        SETTINGS.active_doors = []
         SETTINGS.all_solid_tiles = [] 
         SETTINGS.all_sprites = []
         
         #Retrieve new level info
         self.get_canvas_size()
         gameMap.__init__(SETTINGS.levels_list[SETTINGS.current_level].array)
+        SETTINGS.pathfinding = SETTINGS.levels_list[SETTINGS.current_level].pathfinding
+        PATHFINDING.next_hops.load(SETTINGS.levels_list[SETTINGS.current_level].array)
         SETTINGS.player_rect.center = (SETTINGS.levels_list[SETTINGS.current_level].player_pos[0]*SETTINGS.tile_size, SETTINGS.levels_list[SETTINGS.current_level].player_pos[1]*SETTINGS.tile_size)
         SETTINGS.player_rect.centerx += SETTINGS.tile_size/2
         SETTINGS.player_rect.centery += SETTINGS.tile_size/2
         gamePlayer.real_x = SETTINGS.player_rect.centerx
         gamePlayer.real_y = SETTINGS.player_rect.centery
+        COLLISION.world.build()
 
         if SETTINGS.shade and SETTINGS.levels_list[SETTINGS.current_level].shade:
             SETTINGS.shade_rgba = SETTINGS.levels_list[SETTINGS.current_level].shade_rgba
             SETTINGS.shade_visibility = SETTINGS.levels_list[SETTINGS.current_level].shade_visibility
+        #Shaded wall textures for this level's shade colour
+        gameRaycast.build_shade_tables()
 
         if SETTINGS.current_level > 0:
             SETTINGS.changing_level = False
@@ -160,7 +172,8 @@ class Load:
 
         SETTINGS.player_states['title'] = True
                 
-        SETTINGS.walkable_area = list(PATHFINDING.pathfind(SETTINGS.player_map_pos, SETTINGS.all_tiles[-1].map_pos))
+        SETTINGS.walkable_area = MAP.flood_fill(SETTINGS.player_map_pos)
+        VISIBILITY.service.build()
         gameMap.move_inaccessible_entities()
         ENTITIES.spawn_npcs()
         ENTITIES.spawn_items()
@@ -244,6 +257,11 @@ class Canvas:
                       pygame.Surface((self.width, self.height/18)).convert_alpha()]
         self.rgba = [SETTINGS.shade_rgba[0], SETTINGS.shade_rgba[1], SETTINGS.shade_rgba[2], int(min(255, SETTINGS.shade_rgba[3]*(50/SETTINGS.shade_visibility)))]
 
+        #Floor and ceiling. Built on first draw.
+        self.background = None
+        self.floor_tables = None
+        self.floor_surface = None
+
     def change_mode(self):
         if SETTINGS.mode == 1: #1 - 3D / 0 - 2D
             SETTINGS.mode = 0
@@ -257,18 +275,13 @@ class Canvas:
         if SETTINGS.mode == 1:
             # Draw textured ceiling and floor
             if SETTINGS.ceiling_texture and SETTINGS.floor_texture:
-                # Tile the ceiling texture across the top half
-                tile_width = SETTINGS.ceiling_texture.get_width()
-                tile_height = SETTINGS.ceiling_texture.get_height()
-
-                for x in range(0, self.width, tile_width):
-                    for y in range(0, int(self.height/2), tile_height):
-                        self.canvas.blit(SETTINGS.ceiling_texture, (x, y))
-
-                # Tile the floor texture across the bottom half
-                for x in range(0, self.width, tile_width):
-                    for y in range(int(self.height/2), self.height, tile_height):
-                        self.canvas.blit(SETTINGS.floor_texture, (x, y))
+                if SETTINGS.floor_casting and RAYCAST.numpy:
+                    self.cast_floor()
+                else:
+                    # Textures never change, so the tiled background is only made once
+                    if not self.background:
+                        self.compose_background()
+                    self.canvas.blit(self.background, (0, 0))
             else:
                 # Fallback to solid colors
                 self.canvas.fill(SETTINGS.levels_list[SETTINGS.current_level].sky_color)
@@ -287,6 +300,89 @@ class Canvas:
         else:
             self.window.fill(SETTINGS.WHITE)
 
+    def compose_background(self):
+        self.background = pygame.Surface((self.width, self.height)).convert()
+
+        # Tile the ceiling texture across the top half
+        tile_width = SETTINGS.ceiling_texture.get_width()
+        tile_height = SETTINGS.ceiling_texture.get_height()
+
+        for x in range(0, self.width, tile_width):
+            for y in range(0, int(self.height/2), tile_height):
+                self.background.blit(SETTINGS.ceiling_texture, (x, y))
+
+        # Tile the floor texture across the bottom half
+        for x in range(0, self.width, tile_width):
+            for y in range(int(self.height/2), self.height, tile_height):
+                self.background.blit(SETTINGS.floor_texture, (x, y))
+
+    def build_floor_tables(self):
+        numpy = RAYCAST.numpy
+        horizon = int(self.height/2)
+        #Distance to the floor seen on each row below the horizon. Uses the same projection as the walls,
+        #with the eye half a tile above the floor. The ceiling rows mirror the floor rows.
+        projection = 360 / math.tan(math.radians(SETTINGS.fov * 0.8))
+        rows = numpy.arange(horizon) + 0.5
+        self.floor_tables = {
+            'key' : (SETTINGS.fov, self.height),
+            'row_dist' : (SETTINGS.tile_size / 2) * projection / rows,
+            'floor' : pygame.surfarray.map_array(self.canvas, pygame.surfarray.array3d(SETTINGS.floor_texture)),
+            'ceiling' : pygame.surfarray.map_array(self.canvas, pygame.surfarray.array3d(SETTINGS.ceiling_texture)),
+            }
+
+    def cast_floor(self):
+        '''== Perspective correct floor and ceiling ==\nCast at ray resolution, then stretched to the canvas like the walls'''
+        numpy = RAYCAST.numpy
+        if not self.floor_tables or self.floor_tables['key'] != (SETTINGS.fov, self.height):
+            self.build_floor_tables()
+
+        degrees, betas = gameRaycast.ray_angles()
+        angles = numpy.radians(degrees)
+        betas = numpy.radians(betas)
+
+        #One pixel column per ray
+        if not self.floor_surface or self.floor_surface.get_width() != len(degrees):
+            self.floor_surface = pygame.Surface((len(degrees), self.height)).convert(self.canvas)
+        pixels = pygame.surfarray.pixels2d(self.floor_surface)
+        RAYCAST.run_strips(lambda start, end: self.cast_floor_strip(pixels, angles, betas, start, end), len(degrees))
+        del pixels
+
+        #Each ray covers wall_width columns and the last one takes what is left, as in RAYCAST.strip_columns
+        wall_width = gameRaycast.wall_width
+        covered = min(len(degrees) * wall_width, self.width)
+        self.canvas.blit(pygame.transform.scale(self.floor_surface, (covered, self.height)), (0, 0))
+        if covered < self.width:
+            last_ray = self.floor_surface.subsurface((len(degrees) - 1, 0, 1, self.height))
+            self.canvas.blit(pygame.transform.scale(last_ray, (self.width - covered, self.height)), (covered, 0))
+
+    def cast_floor_strip(self, pixels, angles, betas, start, end):
+        numpy = RAYCAST.numpy
+        horizon = int(self.height/2)
+        #World position of the floor under every (ray, row), in float32 to keep the arrays small
+        row_dist = self.floor_tables['row_dist'].astype(numpy.float32)
+        ray_scale = 1 / numpy.cos(betas[start:end])
+        world_x = numpy.outer((numpy.cos(angles[start:end]) * ray_scale).astype(numpy.float32), row_dist)
+        world_x += SETTINGS.player_rect.centerx
+        world_y = numpy.outer((numpy.sin(angles[start:end]) * ray_scale).astype(numpy.float32), row_dist)
+        numpy.subtract(SETTINGS.player_rect.centery, world_y, out=world_y)
+        world_x = numpy.floor(world_x, out=world_x).astype(numpy.int32)
+        world_y = numpy.floor(world_y, out=world_y).astype(numpy.int32)
+
+        #Texel index per texture size. Floor and ceiling usually share one.
+        texels = {}
+        for half, rows in (('floor', slice(horizon, horizon*2)), ('ceiling', slice(horizon-1, None, -1))):
+            texture = self.floor_tables[half]
+            if (texture == texture.flat[0]).all():
+                #Flat colour, nothing to look up
+                pixels[start:end, rows] = texture.flat[0]
+                continue
+            if texture.shape not in texels:
+                index = world_x % texture.shape[0]
+                index *= texture.shape[1]
+                index += world_y % texture.shape[1]
+                texels[texture.shape] = index
+            pixels[start:end, rows] = texture.reshape(-1).take(texels[texture.shape])
+
     def present(self):
         """Display only canvas - no HUD area"""
         # Window shows only canvas (green border area)
@@ -337,42 +433,25 @@ def sort_atan(x):
 
 def render_screen(canvas):
     '''render_screen(canvas) -> Renders everything but NPC\'s'''
-    SETTINGS.rendered_tiles = []
-
     #Get sprite positions
-    for sprite in SETTINGS.all_sprites:
-        sprite.get_pos(canvas)
-
-    #Sort zbuffer and solid tiles
-    SETTINGS.zbuffer = sorted(SETTINGS.zbuffer, key=sort_distance, reverse=True)
-    SETTINGS.all_solid_tiles = sorted(SETTINGS.all_solid_tiles, key=lambda x: (x.type, sort_atan(x), x.distance))
+    SPRITES.project_sprites(canvas)
 
-    #Calculate which tiles are visible
+    #Point the HUD arrow at the end of the level
     for tile in SETTINGS.all_solid_tiles:
-        if tile.distance and SETTINGS.tile_visible[tile.ID]:
-            if sort_atan(tile) <= SETTINGS.fov:
-                if tile.distance < SETTINGS.render * SETTINGS.tile_size:
-                    SETTINGS.rendered_tiles.append(tile)
-                            
-            elif tile.distance <= SETTINGS.tile_size * 1.5:
-                SETTINGS.rendered_tiles.append(tile)
-                
+        if tile.type == 'end':
+            sort_atan(tile)
 
-    #Render all items in zbuffer
+    #Draw walls. Slices never overlap, so they need no sorting.
+    if gameRaycast.batch is not None:
+        gameRaycast.draw_columns(canvas)
     for item in SETTINGS.zbuffer:
-        if item == None:
-            pass
-        elif item.type == 'slice': 
+        if item != None:
             canvas.blit(item.tempslice, (item.xpos, item.rect.y))
-            if item.vh == 'v':
-                #Make vertical walls slightly darker
-                canvas.blit(item.darkslice, (item.xpos, item.rect.y))
-            if SETTINGS.shade:
-                canvas.blit(item.shade_slice, (item.xpos, item.rect.y))
-                
-        else:
-            if item.new_rect.right > 0 and item.new_rect.x < SETTINGS.canvas_actual_width and item.distance < (SETTINGS.render * SETTINGS.tile_size):
-                item.draw(canvas)
+
+    #Draw sprites far to near, depth tested against the walls per column
+    for item in sorted(SETTINGS.sprite_list, key=sort_distance, reverse=True):
+        if item.new_rect.right > 0 and item.new_rect.x < SETTINGS.canvas_actual_width and item.distance < (SETTINGS.draw_distance * SETTINGS.tile_size):
+            item.draw(canvas, SETTINGS.depth_buffer)
                 
     #Draw weapon if it is there
     if SETTINGS.current_gun:
@@ -386,6 +465,7 @@ def render_screen(canvas):
     EFFECTS.render(gameCanvas.canvas)
 
     SETTINGS.zbuffer = []
+    SETTINGS.sprite_list = []
 
     #Draw HUD and canvas to render surface
     gameCanvas.render_surface.blit(canvas, (SETTINGS.axes))
@@ -395,9 +475,10 @@ def render_screen(canvas):
 
 def update_game():
     if SETTINGS.npc_list:
-        for npc in SETTINGS.npc_list:
-            # LASER TAG - Always call think() so dead NPCs can respawn
-            npc.think()
+        # LASER TAG - Every NPC keeps thinking so dead NPCs can respawn, far ones just less often
+        NPC.scheduler.update(SETTINGS.npc_list)
+        PATHFINDING.path_service.update()
+    MAP.update_doors()
 
     SETTINGS.ground_weapon = None
     for item in SETTINGS.all_items:
@@ -455,6 +536,7 @@ def update_game():
             SETTINGS.player_rect.center = (SETTINGS.player_pos[0], SETTINGS.player_pos[1])
             gamePlayer.real_x = SETTINGS.player_rect.centerx
             gamePlayer.real_y = SETTINGS.player_rect.centery
+            COLLISION.world.move(gamePlayer)
 
             # Refill weapon magazine
             if SETTINGS.current_gun:
@@ -522,6 +604,7 @@ def main_loop():
     
     while not game_exit:
         SETTINGS.zbuffer = []
+        SETTINGS.sprite_list = []
         if SETTINGS.play_seconds >= 60:
             SETTINGS.statistics['playtime'] += 1
             SETTINGS.play_seconds = 0
@@ -637,6 +720,8 @@ def main_loop():
         delta_time = clock.tick(SETTINGS.fps)
         SETTINGS.dt = delta_time / 1000.0
         SETTINGS.cfps = int(clock.get_fps())
+        if not SETTINGS.menu_showing:
+            qualityController.update(clock)
         #pygame.display.set_caption(SETTINGS.caption % SETTINGS.cfps)
 
        # allfps.append(clock.get_fps())
@@ -681,6 +766,7 @@ if __name__ == '__main__':
     #Controller classes
     menuController = MENU.Controller(gameCanvas.canvas)
     musicController = MUSIC.Music()
+    qualityController = QUALITY.Controller()
 
     #Run at last
     main_loop()
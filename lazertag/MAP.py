@@ -7,6 +7,10 @@ import pygame
 import math
 import random
 import os
+from collections import deque
+
+#Called with the tile whenever a tile turns solid or not solid (doors). Line of sight and pathfinding caches listen here.
+solid_listeners = []
 
 class Map:
     '''== Create the map ==\narray -> Level to be loaded'''
@@ -16,10 +20,15 @@ class Map:
         self.width = len(self.array[0])-1
         self.height = len(self.array)-1
         SETTINGS.current_level_size = (self.width, self.height)
+        #Grid of tiles indexed [row][column] for O(1) lookups (raycasting)
+        SETTINGS.tile_grid = []
 
         for row in range(len(self.array)):
+            SETTINGS.tile_grid.append([])
             for column in range(len(self.array[row])):
-                SETTINGS.all_tiles.append(Tile(self.array[row][column], [column*self.tile_size, row*self.tile_size], [column, row]))
+                tile = Tile(self.array[row][column], [column*self.tile_size, row*self.tile_size], [column, row])
+                SETTINGS.all_tiles.append(tile)
+                SETTINGS.tile_grid[row].append(tile)
             
         for tile in SETTINGS.all_tiles:
             if SETTINGS.tile_solid[tile.ID]:
@@ -40,12 +49,15 @@ class Map:
         for i in SETTINGS.walkable_area:
             if i.type != 'hdoor' and i.type != 'vdoor':
                 wa.append(i.map_pos)
+
+        def accessible(pos):
+            return is_walkable(pos) and SETTINGS.tile_grid[pos[1]][pos[0]].type not in ('hdoor', 'vdoor')
             
-        move_items = [x for x in SETTINGS.levels_list[SETTINGS.current_level].items if list(x[0]) not in wa]
-        move_npcs = [x for x in SETTINGS.levels_list[SETTINGS.current_level].npcs if list(x[0]) not in wa]
+        move_items = [x for x in SETTINGS.levels_list[SETTINGS.current_level].items if not accessible(x[0])]
+        move_npcs = [x for x in SETTINGS.levels_list[SETTINGS.current_level].npcs if not accessible(x[0])]
         
-        item_positions = [x[0] for x in SETTINGS.levels_list[SETTINGS.current_level].items if list(x[0]) in wa]
-        npc_positions = [x[0] for x in SETTINGS.levels_list[SETTINGS.current_level].npcs if list(x[0]) in wa]
+        item_positions = [x[0] for x in SETTINGS.levels_list[SETTINGS.current_level].items if accessible(x[0])]
+        npc_positions = [x[0] for x in SETTINGS.levels_list[SETTINGS.current_level].npcs if accessible(x[0])]
 
         possible_item_positions = [x for x in wa if tuple(wa) not in item_positions]
         temp_possible_npc_positions = [x for x in wa if tuple(wa) not in npc_positions]
@@ -113,20 +125,28 @@ class Tile:
                 self.close_sound = pygame.mixer.Sound(os.path.join('sounds', 'other', 'door_close.ogg'))
 
                 SETTINGS.all_doors.append(self)
+                SETTINGS.door_grid[tuple(self.map_pos)] = self
 
 
     def draw(self, canvas):
         canvas.blit(self.icon, (self.rect.x/4, self.rect.y/4))
 
-    def get_dist(self, pos, *called):
+    def get_dist(self, pos):
         xpos = self.rect.center[0] - pos[0]
         ypos = pos[1] - self.rect.center[1]
         self.distance = math.sqrt(xpos*xpos + ypos*ypos)
+        return self.distance
 
-        if (self.state and self.state != 'closed') and called != ('npc',): #lol
+    def set_solid(self, solid):
+        if self.solid != solid:
+            self.solid = solid
+            for listener in solid_listeners:
+                listener(self)
+
+    def use_door(self):
+        #Start opening a closed door. update_doors() animates it from there.
+        if self.state == 'closed':
             self.sesam_luk_dig_op()
-            
-        return self.distance
 
     def sesam_luk_dig_op(self):
         if self.open > SETTINGS.tile_size:
@@ -136,6 +156,7 @@ class Tile:
             
         if self.state == 'closed':
             self.state = 'opening'
+            SETTINGS.active_doors.append(self)
             
         elif self.state == 'opening':
             if self.open == 0:
@@ -145,9 +166,9 @@ class Tile:
                 self.open += SETTINGS.tile_size * SETTINGS.dt
             else:
                 self.state = 'open'
-                self.solid = False
+                self.set_solid(False)
             if self.open > SETTINGS.tile_size/1.4:
-                self.solid = False
+                self.set_solid(False)
 
         elif self.state == 'open':
             self.timer += SETTINGS.dt
@@ -157,7 +178,7 @@ class Tile:
                         break
                 else:   
                     self.state = 'closing'
-                    self.solid = True
+                    self.set_solid(True)
                     self.timer = 0
 
         elif self.state == 'closing':
@@ -169,5 +190,67 @@ class Tile:
                 self.state = 'closed'
 
 
-            
-        
+def update_doors():
+    '''== Animate the doors that are not closed ==\nOnce per frame'''
+    for door in SETTINGS.active_doors[:]:
+        door.get_dist(SETTINGS.player_rect.center)
+        door.sesam_luk_dig_op()
+        if door.state == 'closed':
+            SETTINGS.active_doors.remove(door)
+
+def doors_near(map_pos):
+    '''== Doors in and around a tile ==\ndoors_near(map_pos) -> list of door tiles'''
+    doors = []
+    for column in range(map_pos[0]-1, map_pos[0]+2):
+        for row in range(map_pos[1]-1, map_pos[1]+2):
+            door = SETTINGS.door_grid.get((column, row))
+            if door:
+                doors.append(door)
+    return doors
+
+def tile_walkable(ID):
+    '''== Can NPCs walk on tiles with this ID? ==\ntile_walkable(ID) -> boolean\nDoors count as walkable, NPCs open them. Used by the flood fill and all pathfinding.'''
+    return SETTINGS.texture_type[ID] in ('hdoor', 'vdoor') or not SETTINGS.tile_solid[ID]
+
+def flood_fill(start):
+    '''== Walkable area and connected components ==\nflood_fill(start) -> tiles that can be reached from start, start first\nSets SETTINGS.tile_components, where the area reached from start is component 0'''
+    SETTINGS.tile_components = [[None] * len(row) for row in SETTINGS.tile_grid]
+
+    def walkable(column, row):
+        if row < 0 or column < 0 or row >= len(SETTINGS.tile_grid) or column >= len(SETTINGS.tile_grid[row]):
+            return False
+        return SETTINGS.tile_components[row][column] is None and tile_walkable(SETTINGS.tile_grid[row][column].ID)
+
+    def fill(column, row, component):
+        area = [SETTINGS.tile_grid[row][column]]
+        SETTINGS.tile_components[row][column] = component
+        queue = deque([(column, row)])
+        while queue:
+            column, row = queue.popleft()
+            for adj in ((column, row-1), (column+1, row), (column, row+1), (column-1, row)):
+                if walkable(adj[0], adj[1]):
+                    SETTINGS.tile_components[adj[1]][adj[0]] = component
+                    area.append(SETTINGS.tile_grid[adj[1]][adj[0]])
+                    queue.append(adj)
+        return area
+
+    walkable_area = fill(start[0], start[1], 0)
+    component = 1
+    for row in range(len(SETTINGS.tile_grid)):
+        for column in range(len(SETTINGS.tile_grid[row])):
+            if walkable(column, row):
+                fill(column, row, component)
+                component += 1
+    return walkable_area
+
+def is_walkable(map_pos):
+    '''== Can the tile be reached from where the level starts? ==\nis_walkable([column, row]) -> boolean'''
+    column, row = map_pos[0], map_pos[1]
+    if row < 0 or column < 0 or row >= len(SETTINGS.tile_components) or column >= len(SETTINGS.tile_components[row]):
+        return False
+    return SETTINGS.tile_components[row][column] == 0
+
+def walkable_near(map_pos, distance):
+    '''== Walkable tiles in a square around a tile ==\nwalkable_near(map_pos, distance) -> list of tiles at most distance tiles away on each axis'''
+    return [SETTINGS.tile_grid[row][column] for row in range(map_pos[1]-distance, map_pos[1]+distance+1)
+            for column in range(map_pos[0]-distance, map_pos[0]+distance+1) if is_walkable([column, row])]
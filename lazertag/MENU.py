@@ -430,7 +430,6 @@ class NewMenu(Menu):
         SETTINGS.fov = self.settings['fov']
         SETTINGS.player_states['cspeed'] = SETTINGS.player_speed
         SETTINGS.aiming = False
-        SETTINGS.player.update_collide_list = True
 
     def draw_no_levels(self, canvas):
         if self.timer <= 1.2:
@@ -1,15 +1,116 @@
 import SETTINGS
 import SPRITES
 import PATHFINDING
+import MAP
 import ITEMS
 import SOUND
+import VISIBILITY
+import COLLISION
 import os
 import random
 import math
+import time
 import pygame
 #stats format in bottom of script
 #pos is in tiles, face in degrees, frame_interval is seconds between frames, speed is pixels/second
 
+#Rows of an NPC sprite sheet: (animation, row, frames). Frames are 64x128.
+SHEET_ROWS = (('stand', 0, 8), ('front', 1, 10), ('frontright', 2, 10), ('right', 3, 10),
+              ('backright', 4, 10), ('back', 5, 10), ('die', 6, 11), ('hit', 7, 6))
+#Animations that are mirrored versions of another one
+SHEET_FLIPPED = (('backleft', 'backright'), ('left', 'right'), ('frontleft', 'frontright'))
+
+class AnimationAtlas:
+    '''== Shared NPC animation frames ==\nEvery sprite sheet is loaded and cut once per process. NPCs only hold references.'''
+    def __init__(self):
+        self.sheets = {}
+        self.load_time = 0
+        self.bytes = 0
+        self.requests = 0
+
+    def get(self, path):
+        '''get(path) -> {animation : [frames]}, plus 'sheet' for the whole image'''
+        self.requests += 1
+        if path not in self.sheets:
+            self.sheets[path] = self.load(path)
+        return self.sheets[path]
+
+    def load(self, path):
+        start = time.perf_counter()
+        sheet = pygame.image.load(path).convert_alpha()
+        frames = {'sheet' : sheet}
+        for animation, row, count in SHEET_ROWS:
+            frames[animation] = [sheet.subsurface(column*64, row*128, 64, 128).convert_alpha() for column in range(count)]
+        for animation, original in SHEET_FLIPPED:
+            frames[animation] = [pygame.transform.flip(frame, True, False) for frame in frames[original]]
+        frames['hurt'] = [frames['die'][0]]
+
+        surfaces = [sheet] + [frame for animation, _row, _count in SHEET_ROWS for frame in frames[animation]] + [frame for animation, _original in SHEET_FLIPPED for frame in frames[animation]]
+        size = sum(x.get_width() * x.get_height() * x.get_bytesize() for x in surfaces)
+        self.bytes += size
+        self.load_time += time.perf_counter() - start
+        return frames
+
+    def stats(self):
+        '''stats() -> sheets, load time (s), memory (bytes) and how many NPCs reused a loaded sheet'''
+        return {'sheets' : len(self.sheets), 'load time' : self.load_time, 'bytes' : self.bytes, 'reused' : self.requests - len(self.sheets)}
+
+animation_atlas = AnimationAtlas()
+
+class ThinkScheduler:
+    '''== AI level of detail ==\nNPCs near the player, in a fight or in sight on screen think every frame. The rest think less often, within a time budget per frame.'''
+    def __init__(self):
+        self.ticks = 0
+        self.deferred = 0
+
+    def update(self, npc_list):
+        start = time.perf_counter()
+        #Line of sight to the player for everyone at once, detect_player() reads the answers
+        alive = [npc for npc in npc_list if not npc.dead]
+        in_sight = set(npc for npc, visible in zip(alive, VISIBILITY.service.player_visible(alive)) if visible and npc.sprite.drawable)
+        due = []
+        for npc in npc_list:
+            npc.waiting += SETTINGS.dt
+            interval = self.interval(npc, npc in in_sight)
+            if interval == 0:
+                self.tick(npc)
+            elif npc.waiting >= interval:
+                due.append((npc.waiting - interval, npc))
+
+        #The most overdue go first and the first one always thinks, so nobody waits forever.
+        #What does not fit in the budget waits for the next frame.
+        for number, (overdue, npc) in enumerate(sorted(due, key=lambda x: x[0], reverse=True)):
+            if number > 0 and (time.perf_counter() - start) * 1000 > SETTINGS.ai_budget:
+                self.deferred += 1
+            else:
+                self.tick(npc)
+
+    def interval(self, npc, in_sight=False):
+        #Seconds between thinks. 0 is every frame.
+        if npc.state == 'attacking' or npc.state == 'fleeing' or npc.hurting or (npc.health <= 0 and not npc.dead) or SETTINGS.player_states['dead']:
+            return 0
+        #NPCs the player can see move every frame, or they would stutter
+        if in_sight:
+            return 0
+        xpos = SETTINGS.player_rect.centerx - npc.rect.centerx
+        ypos = SETTINGS.player_rect.centery - npc.rect.centery
+        dist = math.sqrt(xpos*xpos + ypos*ypos)
+        if dist <= SETTINGS.ai_near_distance * SETTINGS.tile_size:
+            return 0
+        elif npc.dead or dist > SETTINGS.render * SETTINGS.tile_size * 1.2:
+            return SETTINGS.ai_far_interval
+        return SETTINGS.ai_mid_interval
+
+    def tick(self, npc):
+        #Timers and movement use the time since the last think, at most ai_max_dt at once.
+        #The rest is carried over, so timers keep real time.
+        npc.dt = min(npc.waiting, SETTINGS.ai_max_dt)
+        npc.waiting -= npc.dt
+        npc.think()
+        self.ticks += 1
+
+scheduler = ThinkScheduler()
+
 class Npc:
 
     def __init__(self, stats, sounds, texture, team='orange'):
@@ -21,7 +122,6 @@ class Npc:
         self.pos = [self.map_pos[0]*SETTINGS.tile_size, self.map_pos[1]*SETTINGS.tile_size]
         self.face = stats['face']
         self.frame_interval = stats['spf']
-        self.dda_list = SETTINGS.walkable_area + [x for x in SETTINGS.all_solid_tiles if x.type == 'sprite']
 
         # Team assignment for laser tag gameplay
         self.team = team  # 'green' or 'orange'
@@ -47,7 +147,8 @@ class Npc:
         self.running_animation = None
         self.add = 0
         self.dist = None
-        self.collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list
+        #Position in SETTINGS.npc_list. NPCs only bump into the ones made before them.
+        self.order = len(SETTINGS.npc_list)
         self.solid = True
         self.side = None
         self.in_canvas = False
@@ -107,35 +208,31 @@ class Npc:
 
         #Textures and animations
         self.texture_path = texture # Used for creating new NPCS
-        self.texture = pygame.image.load(texture).convert_alpha()
+        frames = animation_atlas.get(texture)
+        self.texture = frames['sheet']
         self.texturerect = self.texture.get_rect()
         
-        self.stand_texture = [self.texture.subsurface(0,0,64,128).convert_alpha(), self.texture.subsurface(64,0,64,128).convert_alpha(), self.texture.subsurface(128,0,64,128).convert_alpha(), self.texture.subsurface(192,0,64,128).convert_alpha(), self.texture.subsurface(256,0,64,128).convert_alpha(), self.texture.subsurface(320,0,64,128).convert_alpha(), self.texture.subsurface(384,0,64,128).convert_alpha(), self.texture.subsurface(448,0,64,128).convert_alpha()]
-        self.front_texture = [self.texture.subsurface(0,128,64,128).convert_alpha(), self.texture.subsurface(64,128,64,128).convert_alpha(), self.texture.subsurface(128,128,64,128).convert_alpha(), self.texture.subsurface(192,128,64,128).convert_alpha(), self.texture.subsurface(256,128,64,128).convert_alpha(), self.texture.subsurface(320,128,64,128).convert_alpha(), self.texture.subsurface(384,128,64,128).convert_alpha(), self.texture.subsurface(448,128,64,128).convert_alpha(), self.texture.subsurface(512,128,64,128).convert_alpha(), self.texture.subsurface(576,128,64,128).convert_alpha()]
-        self.frontright_texture = [self.texture.subsurface(0,256,64,128).convert_alpha(), self.texture.subsurface(64,256,64,128).convert_alpha(), self.texture.subsurface(128,256,64,128).convert_alpha(), self.texture.subsurface(192,256,64,128).convert_alpha(), self.texture.subsurface(256,256,64,128).convert_alpha(), self.texture.subsurface(320,256,64,128).convert_alpha(), self.texture.subsurface(384,256,64,128).convert_alpha(), self.texture.subsurface(448,256,64,128).convert_alpha(), self.texture.subsurface(512,256,64,128).convert_alpha(), self.texture.subsurface(576,256,64,128).convert_alpha()]
-        self.right_texture = [self.texture.subsurface(0,384,64,128).convert_alpha(), self.texture.subsurface(64,384,64,128).convert_alpha(), self.texture.subsurface(128,384,64,128).convert_alpha(), self.texture.subsurface(192,384,64,128).convert_alpha(), self.texture.subsurface(256,384,64,128).convert_alpha(), self.texture.subsurface(320,384,64,128).convert_alpha(), self.texture.subsurface(384,384,64,128).convert_alpha(), self.texture.subsurface(448,384,64,128).convert_alpha(), self.texture.subsurface(512,384,64,128).convert_alpha(), self.texture.subsurface(576,384,64,128).convert_alpha()]
-        self.backright_texture = [self.texture.subsurface(0,512,64,128).convert_alpha(), self.texture.subsurface(64,512,64,128).convert_alpha(), self.texture.subsurface(128,512,64,128).convert_alpha(), self.texture.subsurface(192,512,64,128).convert_alpha(), self.texture.subsurface(256,512,64,128).convert_alpha(), self.texture.subsurface(320,512,64,128).convert_alpha(), self.texture.subsurface(384,512,64,128).convert_alpha(), self.texture.subsurface(448,512,64,128).convert_alpha(), self.texture.subsurface(512,512,64,128).convert_alpha(), self.texture.subsurface(576,512,64,128).convert_alpha()]
-        self.back_texture = [self.texture.subsurface(0,640,64,128).convert_alpha(), self.texture.subsurface(64,640,64,128).convert_alpha(), self.texture.subsurface(128,640,64,128).convert_alpha(), self.texture.subsurface(192,640,64,128).convert_alpha(), self.texture.subsurface(256,640,64,128).convert_alpha(), self.texture.subsurface(320,640,64,128).convert_alpha(), self.texture.subsurface(384,640,64,128).convert_alpha(), self.texture.subsurface(448,640,64,128).convert_alpha(), self.texture.subsurface(512,640,64,128).convert_alpha(), self.texture.subsurface(576,640,64,128).convert_alpha()]
-        
-        self.backleft_texture = []
-        self.left_texture = []
-        self.frontleft_texture = []
-
-        for frame in self.backright_texture:
-            self.backleft_texture.append(pygame.transform.flip(frame, True, False))
-        for frame in self.right_texture:
-            self.left_texture.append(pygame.transform.flip(frame, True, False))
-        for frame in self.frontright_texture:
-            self.frontleft_texture.append(pygame.transform.flip(frame, True, False))
-
-        self.die_texture = [self.texture.subsurface(0,768,64,128).convert_alpha(), self.texture.subsurface(64,768,64,128).convert_alpha(), self.texture.subsurface(128,768,64,128).convert_alpha(), self.texture.subsurface(192,768,64,128).convert_alpha(), self.texture.subsurface(256,768,64,128).convert_alpha(), self.texture.subsurface(320,768,64,128).convert_alpha(), self.texture.subsurface(384,768,64,128).convert_alpha(), self.texture.subsurface(448,768,64,128).convert_alpha(), self.texture.subsurface(512,768,64,128).convert_alpha(), self.texture.subsurface(576,768,64,128).convert_alpha(), self.texture.subsurface(640,768,64,128).convert_alpha()]
-        self.hit_texture = [self.texture.subsurface(0,896,64,128).convert_alpha(), self.texture.subsurface(64,896,64,128).convert_alpha(), self.texture.subsurface(128,896,64,128).convert_alpha(), self.texture.subsurface(192,896,64,128).convert_alpha(), self.texture.subsurface(256,896,64,128).convert_alpha(), self.texture.subsurface(320,896,64,128).convert_alpha()]
-        self.hurt_texture = [self.die_texture[0]]
+        self.stand_texture = frames['stand']
+        self.front_texture = frames['front']
+        self.frontright_texture = frames['frontright']
+        self.right_texture = frames['right']
+        self.backright_texture = frames['backright']
+        self.back_texture = frames['back']
+        self.backleft_texture = frames['backleft']
+        self.left_texture = frames['left']
+        self.frontleft_texture = frames['frontleft']
+        self.die_texture = frames['die']
+        self.hit_texture = frames['hit']
+        self.hurt_texture = frames['hurt']
         self.current_frame = 1
         self.update_timer = 0
+        #Time since this NPC last thought. Set by the scheduler, which may skip frames for it.
+        self.dt = 0
+        self.waiting = 0
 
         #Creating the sprite rect is awful, I know. Keeps it from entering walls.
         self.sprite = SPRITES.Sprite(self.front_texture[1], self.ID, [self.rect.centerx - int(SETTINGS.tile_size / 12), self.rect.centery - int(SETTINGS.tile_size / 10)], 'npc', self)
+        COLLISION.world.move(self)
 
         #The position in SETTINGS.all_sprites of this NPC
         self.num = len(SETTINGS.all_sprites)-1
@@ -147,7 +244,7 @@ class Npc:
 
         # LASER TAG - Handle NPC respawning
         if self.dead:
-            self.respawn_timer += SETTINGS.dt
+            self.respawn_timer += self.dt
             if self.respawn_timer >= 3:  # Respawn after 3 seconds
                 # Reset NPC state
                 self.dead = False
@@ -168,8 +265,8 @@ class Npc:
                 print(f"[LASER TAG] {self.team.upper()} team NPC respawned at spawn point")
 
         if not self.dead:
-            self.timer += SETTINGS.dt
-            self.update_timer += SETTINGS.dt
+            self.timer += self.dt
+            self.update_timer += self.dt
             if self.update_timer >= 2:
                 self.update_timer = 0
 
@@ -264,6 +361,9 @@ class Npc:
             self.animate('dying')
             self.render()
 
+        #Snapping to a path tile or respawning moves the rect outside collide_update
+        COLLISION.world.move(self)
+
     def render(self):
         '''== Draw the NPC =='''
         if self.dead:
@@ -379,75 +479,19 @@ class Npc:
 
     def detect_player(self):
         '''== Is player visible from NPC position? ==\ndetect_player(self) -> boolean'''
-        own_tile = self.map_pos
-        #front_tile = [own_tile[0] + self.front_tile[0], own_tile[1] + self.front_tile[1]]
-        player_tile = SETTINGS.player_map_pos
-
-        #DDA Algorithm
-        x1,y1 = own_tile[0], own_tile[1]
-        x2,y2 = player_tile[0], player_tile[1]
-
-        #If the coords are negative, start from player instead of NPC
-        if x1 > x2 or (x1 == x2 and y1 > y2):
-            temp1,temp2 = x1,y1
-            x1,y1 = x2,y2
-            x2,y2 = temp1,temp2
-
-        x,y = x1, y1
-        dx = abs(x2-x1)
-        dy = abs(y2-y1)
-        length = dx if dx > dy else dy
-        #Make sure, you won't divide by 0
-        if length == 0:
-            length = 0.001
-
-        xinc = (x2-x1)/float(length)
-        yinc = (y2-y1)/float(length)
-        mapx = self.round_up(x)
-        mapy = self.round_up(y)
-
-        #Extend DDA algorithm
-        for i in range(int(length)):
-            if i > SETTINGS.render:
-                break
-            x += xinc
-            y += yinc
-            mapx = self.round_up(x)
-            mapy = self.round_up(y)
-            
-            #If line of sight hits a wall
-            next_wall = [tile for tile in self.dda_list if tile.map_pos == [mapx, mapy]]
-            
-            if not next_wall:
-                break
-            else:
-                next_wall = next_wall[0]
-            
-            if SETTINGS.tile_visible[next_wall.ID]:
-                if next_wall.type != 'hdoor' and next_wall.type != 'vdoor':
-                    break
-                elif next_wall.type == 'hdoor' or next_wall.type == 'vdoor':
-                    if next_wall.solid:
-                        break
-            #if player is spotted
-            if mapx == x2 and mapy == y2:
-                return True
+        if VISIBILITY.service.line_of_sight(self.map_pos, SETTINGS.player_map_pos):
+            return True
         if self.dist <= SETTINGS.tile_size/3:
             return True
 
     def collide_update(self, x, y):
         #make sure the NPC doesn't walk inside stuff
-        self.real_x += x * SETTINGS.dt
-        self.real_y += y * SETTINGS.dt
+        self.real_x += x * self.dt
+        self.real_y += y * self.dt
         self.rect.x = self.real_x
         self.rect.y = self.real_y
 
-        if self.collide_list[-1] != SETTINGS.player:
-            self.collide_list.append(SETTINGS.player)
-        else:
-            self.collide_list[-1] = SETTINGS.player
-
-        tile_hit_list = [s for s in self.collide_list if self.rect.colliderect(s)]
+        tile_hit_list = [s for s in COLLISION.world.query(self.rect, self) if s.type != 'npc' or s.order < self.order]
         
         for tile in tile_hit_list:
             if tile.solid:
@@ -464,9 +508,12 @@ class Npc:
                     self.rect.top = tile.rect.bottom
                     self.real_y = self.rect.y
 
-        for door in SETTINGS.all_doors:
-            if door.get_dist(self.rect.center, 'npc') <= 50:
-                door.sesam_luk_dig_op()
+        COLLISION.world.move(self)
+
+        #Only doors next to the NPC can be within 50 px
+        for door in MAP.doors_near([int(self.rect.centerx / SETTINGS.tile_size), int(self.rect.centery / SETTINGS.tile_size)]):
+            if door.get_dist(self.rect.center) <= 50:
+                door.use_door()
                 break
 
     def move(self):
@@ -480,12 +527,11 @@ class Npc:
             self.moving = True
 
             #Redo path if tile is occupied by another NPC.
-            if self.update_timer <= 0.5:
+            if self.update_timer <= 0.5 and not PATHFINDING.path_service.waiting(self):
                 for npc in SETTINGS.npc_list:
                     if npc.map_pos == self.path[-1].map_pos:
-                        available_pos = [x for x in SETTINGS.walkable_area if abs(x.map_pos[0]-self.map_pos[0]) <= 3 and abs(x.map_pos[1]-self.map_pos[1]) <= 3]
-                        self.path = PATHFINDING.pathfind(self.map_pos, random.choice(available_pos).map_pos)
-                        self.path_progress = 0
+                        available_pos = MAP.walkable_near(self.map_pos, 3)
+                        PATHFINDING.path_service.request(self, random.choice(available_pos).map_pos)
                         break
 
             if self.rect.colliderect(self.path[self.path_progress].rect) and self.path[self.path_progress] != self.path[-1]:
@@ -494,7 +540,7 @@ class Npc:
             else:
                 #Move down
                 if self.rect.centery < self.path[self.path_progress].rect.centery:
-                    if abs(self.path[self.path_progress].rect.centery - self.rect.centery) >= self.speed * SETTINGS.dt:
+                    if abs(self.path[self.path_progress].rect.centery - self.rect.centery) >= self.speed * self.dt:
                         self.collide_update(0, self.speed)
                         moving_down = True
                     else:
@@ -502,7 +548,7 @@ class Npc:
 
                 #Moving up
                 elif self.rect.centery > self.path[self.path_progress].rect.centery:
-                    if abs(self.path[self.path_progress].rect.centery - self.rect.centery) >= self.speed * SETTINGS.dt:
+                    if abs(self.path[self.path_progress].rect.centery - self.rect.centery) >= self.speed * self.dt:
                         self.collide_update(0, -self.speed)
                         moving_up = True
                     else:
@@ -510,7 +556,7 @@ class Npc:
                     
                 #Move right
                 if self.rect.centerx < self.path[self.path_progress].rect.centerx:
-                    if abs(self.path[self.path_progress].rect.centerx - self.rect.centerx) >= self.speed * SETTINGS.dt:
+                    if abs(self.path[self.path_progress].rect.centerx - self.rect.centerx) >= self.speed * self.dt:
                         self.collide_update(self.speed, 0)
                         moving_right = True
                     else:
@@ -518,7 +564,7 @@ class Npc:
 
                 #Move left
                 elif self.rect.centerx > self.path[self.path_progress].rect.centerx:
-                    if abs(self.rect.centerx - self.path[self.path_progress].rect.centerx) >= self.speed * SETTINGS.dt:
+                    if abs(self.rect.centerx - self.path[self.path_progress].rect.centerx) >= self.speed * self.dt:
                         self.collide_update(-self.speed, 0)
                         moving_left = True
                     else:
@@ -554,33 +600,31 @@ class Npc:
                 self.path_progress = 0
 
         if self.state == 'patrolling':
-            if self.path == []:
+            if self.path == [] and not PATHFINDING.path_service.waiting(self):
                 if random.randint(0,3) == 3:
                     self.state = 'idle'
                     self.sprite.texture = self.stand_texture[4]
                 else:
                     #Make the NPC not walk too far.
-                    available_pos = [x for x in SETTINGS.walkable_area if abs(x.map_pos[0]-self.map_pos[0]) <= 3 and abs(x.map_pos[1]-self.map_pos[1]) <= 3]
-                    self.path = PATHFINDING.pathfind(self.map_pos, random.choice(available_pos).map_pos)
+                    available_pos = MAP.walkable_near(self.map_pos, 3)
+                    PATHFINDING.path_service.request(self, random.choice(available_pos).map_pos)
 
         elif self.state == 'fleeing':
             if self.dist <= SETTINGS.tile_size * 4:
                 flee_pos = random.choice(SETTINGS.walkable_area)
-                player_tile = [x for x in SETTINGS.walkable_area if x.map_pos == SETTINGS.player_map_pos]
-                if player_tile:
-                    player_tile = player_tile[0]
+                if MAP.is_walkable(SETTINGS.player_map_pos):
+                    player_tile = SETTINGS.tile_grid[SETTINGS.player_map_pos[1]][SETTINGS.player_map_pos[0]]
                 else:
                     player_tile = PATHFINDING.find_near_position(SETTINGS.player_map_pos)
                     
                 if self.player_in_view:
                     if self.detect_player() and player_tile:
-                        if ((SETTINGS.walkable_area.index(flee_pos) < SETTINGS.walkable_area.index(player_tile) + int(SETTINGS.current_level_size[0] / 5)) or (SETTINGS.walkable_area.index(flee_pos) > SETTINGS.walkable_area.index(player_tile) - int(SETTINGS.current_level_size[0] / 5))) and self.path == []:
-                            self.path_progress = 0
-                            self.path = PATHFINDING.pathfind(self.map_pos, flee_pos.map_pos)
+                        if ((SETTINGS.walkable_area.index(flee_pos) < SETTINGS.walkable_area.index(player_tile) + int(SETTINGS.current_level_size[0] / 5)) or (SETTINGS.walkable_area.index(flee_pos) > SETTINGS.walkable_area.index(player_tile) - int(SETTINGS.current_level_size[0] / 5))) and self.path == [] and not PATHFINDING.path_service.waiting(self):
+                            PATHFINDING.path_service.request(self, flee_pos.map_pos)
 
     def idle(self):
         #Make the NPC rotate randomly as it stands still.
-        self.idle_timer += SETTINGS.dt
+        self.idle_timer += self.dt
         if self.idle_timer >= 3:
             if random.randint(0,2) == 2:
                 self.face += 45
@@ -628,18 +672,15 @@ class Npc:
 
                 else:
                     if self.dist > SETTINGS.tile_size*0.7 and self.path == []:
-                        self.path_progress = 0
-                        self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)
+                        PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
                         
                     elif self.path != []:
                         try:
                             if self.path[-1].map_pos != SETTINGS.player_map_pos:
                                 if self.dist <= (SETTINGS.render/2) * SETTINGS.tile_size and random.randint(0, 5) == 5:
-                                    self.path_progress = 0
-                                    self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)
+                                    PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
                                 elif random.randint(0,10) >= 8:
-                                    self.path_progress = 0
-                                    self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)                                    
+                                    PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
                             else:
                                 self.move()
                         except:
@@ -657,9 +698,8 @@ class Npc:
                                 self.movechance = 10
                         else:
                             if random.randint(0, self.movechance) == 10:
-                                move_pos = random.choice([x for x in SETTINGS.walkable_area if (x.map_pos[0] <= self.map_pos[0]+1 and x.map_pos[0] >= self.map_pos[0]-1) and (x.map_pos[1] <= self.map_pos[1]+1 and x.map_pos[1] >= self.map_pos[1]-1)])
-                                self.path_progress = 0
-                                self.path = PATHFINDING.pathfind(self.map_pos, move_pos.map_pos)
+                                move_pos = random.choice(MAP.walkable_near(self.map_pos, 1))
+                                PATHFINDING.path_service.request(self, move_pos.map_pos)
                                 self.attacking = False
                                 self.attack_move = True
                                 #This variable is to make sure the NPC doesn't just walk around without attacking.
@@ -696,18 +736,15 @@ class Npc:
                 else:
                     if not self.attack_move:
                         if self.dist >= SETTINGS.tile_size * 2.5 and self.path == []:
-                            self.path_progress = 0
-                            self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)
+                            PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
 
                         elif self.path != []:
                             try:
                                 if self.path[-1].map_pos != SETTINGS.player_map_pos:
                                     if self.dist <= (SETTINGS.render/2) * SETTINGS.tile_size and random.randint(0, 5) == 5:
-                                        self.path_progress = 0
-                                        self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)
+                                        PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
                                     elif random.randint(0,10) == 10:
-                                        self.path_progress = 0
-                                        self.path = PATHFINDING.pathfind(self.map_pos, SETTINGS.player_map_pos)
+                                        PATHFINDING.path_service.request(self, SETTINGS.player_map_pos)
                                 else:
                                     self.move()
                             except:
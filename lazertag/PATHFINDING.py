@@ -1,44 +1,356 @@
 import SETTINGS
+import MAP
+import LEVELS
+import os
+import pickle
 import random
+import time
+import heapq
+import collections
+from collections import deque
 
 #There is some whack error handling. This is because this might be used manually by a human and therefore it needs some human-friendly feedback.
 #This is the A* pathfinding algorithm for NPC movement and more
 #G = Distance from start
-#H = Distance to end
+#H = Distance to end (Manhattan distance)
 #F = G + H
-#open/closedlist syntax = [G, H, F, parent]
-#Parent is from where the node is checked.
+#Nodes are numbered row * width + column on a grid made once per level.
+
+class NavGrid:
+    '''== Walkable grid of the current level ==\nRebuilt when SETTINGS.all_tiles is a new level'''
+    def __init__(self):
+        self.level = None
+        self.width = 0
+        self.tiles = []
+        self.neighbours = []
+        self.walkable = []
+        self.height = 0
+        self.max_pos = None
+        #Nodes taken off the open list, to compare A* and jump point search
+        self.expanded = 0
+
+    def update(self):
+        level = (id(SETTINGS.all_tiles), len(SETTINGS.all_tiles))
+        if level == self.level:
+            return
+        self.level = level
+        path_cache.clear()
+
+        #all_tiles also has the air tile outside the map, so the grid is made to fit every tile in it
+        self.max_pos = max(SETTINGS.all_tiles, key=lambda x: x.map_pos).map_pos
+        self.width = max(tile.map_pos[0] for tile in SETTINGS.all_tiles) + 1
+        height = self.height = max(tile.map_pos[1] for tile in SETTINGS.all_tiles) + 1
+        self.tiles = [None] * (self.width * height)
+        for tile in reversed(SETTINGS.all_tiles):
+            self.tiles[tile.map_pos[1] * self.width + tile.map_pos[0]] = tile
+        walkable = self.walkable = [tile is not None and MAP.tile_walkable(tile.ID) for tile in self.tiles]
+
+        #Walkable neighbours of every node in the order up, right, down, left
+        self.neighbours = []
+        for node in range(len(self.tiles)):
+            column, row = node % self.width, node // self.width
+            adjacent = []
+            if row > 0:
+                adjacent.append(node - self.width)
+            if column < self.width - 1:
+                adjacent.append(node + 1)
+            if row < height - 1:
+                adjacent.append(node + self.width)
+            if column > 0:
+                adjacent.append(node - 1)
+            self.neighbours.append(tuple(x for x in adjacent if walkable[x]))
+
+    def tile_at(self, position):
+        if 0 <= position[0] < self.width and 0 <= position[1] and position[1] * self.width + position[0] < len(self.tiles):
+            return self.tiles[position[1] * self.width + position[0]]
+        return None
+
+    def search(self, start_point, end_point):
+        '''== A* from tile to tile ==\nsearch(start, end) -> path as list of tiles, or the closed nodes {tile : [G, H, F, parent]} if end can't be reached'''
+        width = self.width
+        start = start_point.map_pos[1] * width + start_point.map_pos[0]
+        end = end_point.map_pos[1] * width + end_point.map_pos[0]
+        end_column, end_row = end_point.map_pos
+
+        def h_value(node):
+            return abs(node % width - end_column) + abs(node // width - end_row)
+
+        g = {start : 0}
+        parent = {start : None}
+        closed = []
+        closed_set = set()
+        #(F, H, order, node). order keeps equal nodes first come first served.
+        openlist = [(h_value(start), h_value(start), 0, start)]
+        order = 0
+
+        while openlist:
+            node = heapq.heappop(openlist)[3]
+            if node in closed_set:
+                continue
+            self.expanded += 1
+            closed.append(node)
+            closed_set.add(node)
+            if node == end:
+                path = []
+                while node is not None:
+                    path.append(self.tiles[node])
+                    node = parent[node]
+                return list(reversed(path))
+
+            for adj in self.neighbours[node]:
+                if adj not in closed_set and (adj not in g or g[adj] > g[node] + 1):
+                    g[adj] = g[node] + 1
+                    parent[adj] = node
+                    order += 1
+                    h = h_value(adj)
+                    heapq.heappush(openlist, (g[adj] + h, h, order, adj))
+
+        #Everything reachable was searched
+        closedlist = {}
+        for node in closed:
+            closedlist[self.tiles[node]] = [g[node], h_value(node), g[node] + h_value(node), self.tiles[parent[node]] if parent[node] is not None else None]
+        return closedlist
+
+    def free(self, column, row):
+        return 0 <= column < self.width and 0 <= row < self.height and self.walkable[row * self.width + column]
+
+    def jump(self, column, row, step_x, step_y, end):
+        '''== Walk in one direction until something interesting ==\njump(...) -> (column, row) of the next jump point, or None at a wall'''
+        free = self.free
+        while True:
+            column += step_x
+            row += step_y
+            if not free(column, row):
+                return None
+            if (column, row) == end:
+                return (column, row)
+            if step_x:
+                #A tile beside the line that could not be reached from the tile before
+                if (free(column, row-1) and not free(column-step_x, row-1)) or (free(column, row+1) and not free(column-step_x, row+1)):
+                    return (column, row)
+            else:
+                if (free(column-1, row) and not free(column-1, row-step_y)) or (free(column+1, row) and not free(column+1, row-step_y)):
+                    return (column, row)
+                #Going up or down, a jump point to the side makes this one too
+                if self.jump(column, row, 1, 0, end) or self.jump(column, row, -1, 0, end):
+                    return (column, row)
+
+    def jump_search(self, start_point, end_point):
+        '''== Jump point search from tile to tile ==\nSame result as search(), but only jump points go on the open list. For big open levels.'''
+        width = self.width
+        start = tuple(start_point.map_pos)
+        end = tuple(end_point.map_pos)
+
+        def h_value(point):
+            return abs(point[0] - end[0]) + abs(point[1] - end[1])
+
+        g = {start : 0}
+        parent = {start : None}
+        closed = set()
+        openlist = [(h_value(start), h_value(start), 0, start)]
+        order = 0
+
+        while openlist:
+            point = heapq.heappop(openlist)[3]
+            if point in closed:
+                continue
+            self.expanded += 1
+            closed.add(point)
+            if point == end:
+                #Fill in the straight lines between the jump points
+                path = [self.tiles[end[1] * width + end[0]]]
+                while parent[point] is not None:
+                    before = parent[point]
+                    step_x = (before[0] > point[0]) - (before[0] < point[0])
+                    step_y = (before[1] > point[1]) - (before[1] < point[1])
+                    column, row = point
+                    while (column, row) != before:
+                        column += step_x
+                        row += step_y
+                        path.append(self.tiles[row * width + column])
+                    point = before
+                return list(reversed(path))
+
+            #Only the directions the path could not have taken better before
+            column, row = point
+            if parent[point] is None:
+                directions = ((0, -1), (1, 0), (0, 1), (-1, 0))
+            elif parent[point][0] != column:
+                step_x = 1 if column > parent[point][0] else -1
+                directions = ((0, -1), (0, 1), (step_x, 0))
+            else:
+                step_y = 1 if row > parent[point][1] else -1
+                directions = ((-1, 0), (1, 0), (0, step_y))
+
+            for step_x, step_y in directions:
+                if not self.free(column + step_x, row + step_y):
+                    continue
+                jump_point = self.jump(column, row, step_x, step_y, end)
+                if jump_point and jump_point not in closed:
+                    new_g = g[point] + abs(jump_point[0] - column) + abs(jump_point[1] - row)
+                    if jump_point not in g or g[jump_point] > new_g:
+                        g[jump_point] = new_g
+                        parent[jump_point] = point
+                        order += 1
+                        h = h_value(jump_point)
+                        heapq.heappush(openlist, (new_g + h, h, order, jump_point))
+        return None
+
+nav_grid = NavGrid()
+
+class NextHops:
+    '''== Next step from every walkable tile to every other one ==\nOnly for levels with at most SETTINGS.next_hop_max_tiles walkable tiles. Cached in data/cache by level hash.'''
+    def __init__(self):
+        self.all_tiles = None
+        #(column, row) -> index, and index -> (column, row)
+        self.index = {}
+        self.positions = []
+        #hops[end][start] = index of the next tile from start toward end, -1 if end can't be reached
+        self.hops = []
+
+    def build(self, array):
+        '''== One breadth first search from every walkable tile ==\nbuild(array) -> (positions, hops)'''
+        positions = [(column, row) for row in range(len(array)) for column in range(len(array[row]))
+                     if MAP.tile_walkable(array[row][column])]
+        index = {position : i for i, position in enumerate(positions)}
+        neighbours = []
+        for column, row in positions:
+            adjacent = ((column, row-1), (column+1, row), (column, row+1), (column-1, row))
+            neighbours.append([index[adj] for adj in adjacent if adj in index])
+
+        hops = []
+        for end in range(len(positions)):
+            #Searching out from the end, the tile a tile was found from is its next step toward the end
+            hop = [-1] * len(positions)
+            hop[end] = end
+            queue = deque([end])
+            while queue:
+                node = queue.popleft()
+                for adj in neighbours[node]:
+                    if hop[adj] == -1:
+                        hop[adj] = node
+                        queue.append(adj)
+            hops.append(hop)
+        return positions, hops
+
+    def load(self, array):
+        '''== Table for the level just loaded, from the disk cache if there is one ==\nLevels that are too big get no table'''
+        self.all_tiles = None
+        self.index = {}
+        self.positions = []
+        self.hops = []
+        walkable = sum(1 for row in array for ID in row if MAP.tile_walkable(ID))
+        if walkable > SETTINGS.next_hop_max_tiles:
+            return
+
+        #The table also depends on which tile IDs are walkable, so a texture changing solidity gets a new file
+        rule = [MAP.tile_walkable(ID) for ID in sorted(SETTINGS.tile_solid)]
+        path = os.path.join('data', 'cache', 'hops_%s.dat' % LEVELS.level_hash(array, rule))
+        table = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as file:
+                    table = pickle.load(file)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                table = None
+        if table is None:
+            table = self.build(array)
+            #Written to a temporary file first so a crash can't leave half a table. Without a cache it is just built again.
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as file:
+                    pickle.dump(table, file)
+                os.replace(path + '.tmp', path)
+            except OSError as error:
+                print("[LASER TAG] Could not cache the next-hop table: %s" % error)
+
+        self.positions, self.hops = table
+        self.index = {position : i for i, position in enumerate(self.positions)}
+        self.all_tiles = SETTINGS.all_tiles
+
+    def path(self, start, end):
+        '''== Path from the table ==\npath(start, end) -> list of tiles like pathfind(), None if there is no table or no path'''
+        if self.all_tiles is not SETTINGS.all_tiles:
+            return None
+        node = self.index.get(tuple(start))
+        goal = self.index.get(tuple(end))
+        if node is None or goal is None or self.hops[goal][node] == -1:
+            return None
+        hop = self.hops[goal]
+        path = [node]
+        while node != goal:
+            node = hop[node]
+            path.append(node)
+        return [SETTINGS.tile_grid[self.positions[node][1]][self.positions[node][0]] for node in path]
+
+next_hops = NextHops()
+
+class PathCache:
+    '''== LRU cache of found paths ==\nmax_paths -> How many paths to keep. Cleared when a new level is loaded.\nDoors are always walkable in the search, so opening or closing one never changes a path.'''
+    def __init__(self, max_paths):
+        #(start column, start row, end column, end row) -> path
+        self.paths = collections.OrderedDict()
+        self.max_paths = max_paths
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        path = self.paths.get(key)
+        if path:
+            self.hits += 1
+            self.paths.move_to_end(key)
+        else:
+            self.misses += 1
+        return path
+
+    def add(self, key, path):
+        self.paths[key] = path
+        self.paths.move_to_end(key)
+        while len(self.paths) > self.max_paths:
+            self.paths.popitem(last = False)
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
+
+    def clear(self):
+        self.paths.clear()
+
+path_cache = PathCache(SETTINGS.path_cache_size)
 
 def pathfind(start, end):
     #print(start, end)
     '''== A* Pathfinding ==\npathfind(start, end) -> Shortest path from start to end\nFormat is list with tile objects'''
-    openlist = {}
-    closedlist = {}
-    path = []
+    nav_grid.update()
+    key = (start[0], start[1], end[0], end[1])
+    path = path_cache.get(key)
+    if path:
+        return path
     error = False
 
     #Reports if a node is outside the map
-    if start[0] > max(SETTINGS.all_tiles, key=lambda x: x.map_pos).map_pos[0] or start[1] > max(SETTINGS.all_tiles, key=lambda x: x.map_pos).map_pos[1]:
+    if start[0] > nav_grid.max_pos[0] or start[1] > nav_grid.max_pos[1]:
         print("=== WARNING: ===")
         print("Start point in pathfinding is outiside map!")
         error = True
-    elif end[0] > max(SETTINGS.all_tiles, key=lambda x: x.map_pos).map_pos[0] or end[1] > max(SETTINGS.all_tiles, key=lambda x: x.map_pos).map_pos[1]:
+    elif end[0] > nav_grid.max_pos[0] or end[1] > nav_grid.max_pos[1]:
         print("=== WARNING: ===")
         print("End point in pathfinding is outside map!")
         error = True
               
     if not error:
-        start_point = [x for x in SETTINGS.all_tiles if x.map_pos == start][0]
-        end_point = [x for x in SETTINGS.all_tiles if x.map_pos == end][0]
+        start_point = nav_grid.tile_at(start)
+        end_point = nav_grid.tile_at(end)
         
         #Report errors
-        if SETTINGS.tile_solid[start_point.ID] and (start_point.type != 'hdoor' and start_point.type != 'vdoor'):
+        if not MAP.tile_walkable(start_point.ID):
             print("=== WARNING: ===")
             print("Error! Start point in pathfinding is a solid block!")
             print(start_point.map_pos, start_point.ID)
             print()
             error = True
-        if SETTINGS.tile_solid[end_point.ID] and (end_point.type != 'hdoor' and end_point.type != 'vdoor'):
+        if not MAP.tile_walkable(end_point.ID):
             print("=== WARNING: ===")
             print("Error! End point in pathfinding is a solid block!")
             print(end_point.map_pos, end_point.ID)
@@ -50,64 +362,176 @@ def pathfind(start, end):
             if end_point:
                 end_point = end_point[0]
                 error = False
-                    
-                
+                #The end is a random tile near the asked one, so the path must not be reused for it
+                key = None
 
     if not error:
-        #f_value has to be determined after creation of node.
-        openlist[start_point] = [0, find_distance(start_point, end_point), 0, None]
-        openlist[start_point][2] = f_value(start_point, openlist)
-        current_point = start_point
+        path = next_hops.path(start_point.map_pos, end_point.map_pos)
+        if path is None and SETTINGS.pathfinding == 'jps':
+            path = nav_grid.jump_search(start_point, end_point)
+        #A* also gives the searched area back when there is no path
+        if path is None:
+            path = nav_grid.search(start_point, end_point)
+        #Only real paths are kept, not the closed nodes of a failed search
+        if key and isinstance(path, list):
+            path_cache.add(key, path)
+        return path
 
-        while current_point != end_point:
-            try:
-                current_point = min(openlist, key=lambda k: (openlist[k][2], openlist[k][1]))
-            except:
-                error = True
-                break
-            
-            closedlist[current_point] = openlist[current_point]
-            del openlist[current_point]
+class FlowField:
+    '''== Distance to the player from every tile ==\nShared by all chasing NPCs. Rebuilt when the player changes tile or a new level is loaded.\nDoors are always walkable, so they never change it.'''
+    def __init__(self):
+        self.goal = None
+        self.grid = None
+        self.distance = {}
+        self.builds = 0
 
-            #Find adjacent nodes
-            adjacent = []
-            
-            adj_up = [x for x in SETTINGS.all_tiles if x.map_pos[0] == current_point.map_pos[0] and x.map_pos[1] == current_point.map_pos[1]-1]
-            adj_right = [x for x in SETTINGS.all_tiles if x.map_pos[0] == current_point.map_pos[0]+1 and x.map_pos[1] == current_point.map_pos[1]]
-            adj_down = [x for x in SETTINGS.all_tiles if x.map_pos[0] == current_point.map_pos[0] and x.map_pos[1] == current_point.map_pos[1]+1]
-            adj_left = [x for x in SETTINGS.all_tiles if x.map_pos[0] == current_point.map_pos[0]-1 and x.map_pos[1] == current_point.map_pos[1]]
-            
-            if adj_up:
-                adjacent.append(adj_up[0])
-            if adj_right:
-                adjacent.append(adj_right[0])
-            if adj_down:
-                adjacent.append(adj_down[0])
-            if adj_left:
-                adjacent.append(adj_left[0])
-
-            #Add adjecent nodes to openlist if they are not in closedlist and are not solid
-            for adj in adjacent:
-                
-                if (adj.type == 'hdoor' or adj.type == 'vdoor' or not SETTINGS.tile_solid[adj.ID]) and adj not in closedlist:
-                    if (adj in openlist and openlist[adj][0] > closedlist[current_point][0]+1) or adj not in openlist:
-                        openlist[adj] = [closedlist[current_point][0]+1, find_distance(adj, end_point), 0, current_point]
-                        openlist[adj][2] = f_value(adj, openlist)
-        
-        try:
-            while closedlist[current_point][3] != None:
-                path.append(current_point)
-                current_point = closedlist[current_point][3]
-        except:
-            pass
-            
-        path.append(start_point)
-        path = list(reversed(path))
+    def walkable(self, column, row):
+        if row < 0 or column < 0 or row >= len(SETTINGS.tile_grid) or column >= len(SETTINGS.tile_grid[row]):
+            return False
+        return MAP.tile_walkable(SETTINGS.tile_grid[row][column].ID)
 
-        if error:
-            return closedlist
+    def update(self):
+        goal = tuple(SETTINGS.player_map_pos)
+        if goal == self.goal and self.grid is SETTINGS.tile_grid:
+            return
+        self.goal = goal
+        self.grid = SETTINGS.tile_grid
+        self.builds += 1
+        self.distance = {}
+        if not self.walkable(goal[0], goal[1]):
+            return
+
+        #Breadth first from the player, every step costs the same
+        self.distance[goal] = 0
+        queue = deque([goal])
+        while queue:
+            column, row = queue.popleft()
+            for adj in ((column, row-1), (column+1, row), (column, row+1), (column-1, row)):
+                if adj not in self.distance and self.walkable(adj[0], adj[1]):
+                    self.distance[adj] = self.distance[(column, row)] + 1
+                    queue.append(adj)
+
+    def path(self, start):
+        '''== Path from start to the player ==\npath(start) -> list of tile objects like pathfind(), None if the player can't be reached'''
+        self.update()
+        current = tuple(start)
+        if current not in self.distance:
+            return None
+        path = [SETTINGS.tile_grid[current[1]][current[0]]]
+        #Walk downhill, one tile closer every step
+        while self.distance[current] > 0:
+            column, row = current
+            for adj in ((column, row-1), (column+1, row), (column, row+1), (column-1, row)):
+                if self.distance.get(adj) == self.distance[current] - 1:
+                    current = adj
+                    break
+            path.append(SETTINGS.tile_grid[current[1]][current[0]])
+        return path
+
+flow_field = FlowField()
+
+def path_to_player(start):
+    '''== Path from start to the player ==\nReads the shared flow field, falls back to pathfind() if the player can't be reached from start'''
+    path = flow_field.path(start)
+    if path is None:
+        return pathfind(start, SETTINGS.player_map_pos)
+    return path
+
+#Lower is served first. Anything else (patrolling, idle) gets the last place.
+PRIORITIES = {'attacking' : 0, 'fleeing' : 1}
+
+class PathService:
+    '''== Path requests served within a time budget per frame ==\nNPCs keep their old path until the new one is delivered to npc.path'''
+    def __init__(self):
+        #(start, goal) -> [priority, time requested, [npcs]]
+        self.requests = {}
+        #npc -> (start, goal) it is waiting for
+        self.waiting_npcs = {}
+        self.served = 0
+        self.merged = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def request(self, npc, goal):
+        '''== Ask for a path from the NPC's tile to goal ==\nA newer request from the same NPC replaces the old one'''
+        key = (tuple(npc.map_pos), tuple(goal))
+        old_key = self.waiting_npcs.get(npc)
+        if old_key == key:
+            return
+        if old_key:
+            self.forget(npc, old_key)
+
+        priority = PRIORITIES.get(npc.state, 2)
+        if key in self.requests:
+            #Someone asked for the same path, both get the result
+            request = self.requests[key]
+            request[0] = min(request[0], priority)
+            request[2].append(npc)
+            self.merged += 1
         else:
-            return path
+            self.requests[key] = [priority, time.perf_counter(), [npc]]
+        self.waiting_npcs[npc] = key
+
+    def forget(self, npc, key):
+        request = self.requests[key]
+        request[2].remove(npc)
+        if not request[2]:
+            del self.requests[key]
+        del self.waiting_npcs[npc]
+
+    def waiting(self, npc):
+        return npc in self.waiting_npcs
+
+    def clear(self):
+        self.requests = {}
+        self.waiting_npcs = {}
+
+    def update(self):
+        '''== Serve requests until SETTINGS.path_budget ms are used ==\nAt least one request is served every frame'''
+        if not self.requests:
+            return
+        start = time.perf_counter()
+        served = 0
+        for key in sorted(self.requests, key=lambda k: (self.requests[k][0], self.requests[k][1])):
+            if served and (time.perf_counter() - start) * 1000 > SETTINGS.path_budget:
+                break
+            served += 1
+            priority, requested, npcs = self.requests.pop(key)
+            if list(key[1]) == SETTINGS.player_map_pos:
+                path = path_to_player(list(key[0]))
+            else:
+                path = pathfind(list(key[0]), list(key[1]))
+
+            for npc in npcs:
+                del self.waiting_npcs[npc]
+                npc.path_progress = 0
+                if not isinstance(path, list):
+                    #No path (None or the closed list). An empty path makes the NPC ask again.
+                    npc.path = []
+                    continue
+                npc.path = path
+                #Pick up from where the NPC is now, it may have walked on while waiting
+                for index, tile in enumerate(path):
+                    if tile.map_pos == npc.map_pos:
+                        npc.path_progress = index
+                        break
+
+            latency = time.perf_counter() - requested
+            self.served += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def metrics(self):
+        '''== Queue depth and latency ==\nmetrics() -> dict, latencies in ms'''
+        return {'queue' : len(self.requests),
+                'waiting npcs' : len(self.waiting_npcs),
+                'served' : self.served,
+                'merged' : self.merged,
+                'average latency' : self.total_latency / self.served * 1000 if self.served else 0,
+                'max latency' : self.max_latency * 1000,
+                'path cache hit rate' : path_cache.hit_rate()}
+
+path_service = PathService()
 
 def find_near_position(position):
     adjacent_tiles = [x for x in SETTINGS.walkable_area if (x.map_pos[0] == position[0] + 1 or x.map_pos[0] == position[0] -1 or x.map_pos[0] == position[0])
@@ -121,17 +545,6 @@ def find_near_position(position):
         return None
     
         
-def find_distance(point, end):
-    x = point.map_pos[0] + point.map_pos[1]
-    y = end.map_pos[0] + end.map_pos[1]
-    h = abs(x - y)
-    return h
-    
-
-def f_value(point, openlist):
-    f = openlist[point][2] = openlist[point][0] + openlist[point][1]
-    return f
-
 def random_point(start):
     #cpos = Current pos
     closedlist = []
@@ -4,6 +4,8 @@ import SETTINGS
 import EFFECTS
 import INVENTORY
 import SOUND
+import COLLISION
+import MAP
 import pygame
 import math
 import os
@@ -38,8 +40,6 @@ class Player:
         self.gunsprites_shoot = []
 
         SETTINGS.player = self
-        self.collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list
-        self.update_collide_list = False
         self.solid = True
         self.dead = False
         self.last_call = 0
@@ -47,8 +47,6 @@ class Player:
         self.hurt_sound = pygame.mixer.Sound(os.path.join('sounds', 'other', 'damage.ogg'))
         self.change_level = pygame.mixer.Sound(os.path.join('sounds', 'other', 'next_level.ogg'))
 
-        self.current_level = SETTINGS.current_level
-
         #input variables
         self.mouse2 = 0
         self.esc_pressed = False
@@ -63,16 +61,6 @@ class Player:
         return direction
 
     def control(self, canvas):
-        #Make sure the collide list is complete
-        if len(self.collide_list) != len(SETTINGS.all_solid_tiles + SETTINGS.npc_list):
-            self.collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list
-        elif self.current_level != SETTINGS.current_level:
-            self.collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list
-            self.current_level = SETTINGS.current_level
-        elif self.update_collide_list:
-            self.collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list
-            self.update_collide_list = False
-            
         #Update health
         if self.health != SETTINGS.player_health and SETTINGS.player_states['heal']:
             self.health = SETTINGS.player_health
@@ -168,7 +156,7 @@ class Player:
                 if key[pygame.K_e]:
                     if SETTINGS.middle_slice:
                         if SETTINGS.middle_slice_len <= SETTINGS.tile_size*1.5 and (SETTINGS.middle_slice.type == 'vdoor' or SETTINGS.middle_slice.type == 'hdoor'):
-                            SETTINGS.middle_slice.sesam_luk_dig_op()
+                            SETTINGS.middle_slice.use_door()
                         elif SETTINGS.middle_slice_len <= SETTINGS.tile_size and SETTINGS.middle_slice.type == 'end' and not SETTINGS.player_states['fade']:
                             SETTINGS.player_states['fade'] = True
                             SETTINGS.changing_level = True
@@ -244,7 +232,7 @@ class Player:
         self.rect.x = self.real_x
         self.rect.y = self.real_y
         SETTINGS.player_rect = self.rect
-        tile_hit_list = pygame.sprite.spritecollide(self, self.collide_list, False)
+        tile_hit_list = COLLISION.world.query(self.rect, self)
         
         #Actually there are not only tiles in the list. NPCs as well.
         for tile in tile_hit_list:
@@ -265,33 +253,23 @@ class Player:
         SETTINGS.player_map_pos = [int(self.rect.centerx / SETTINGS.tile_size), int(self.rect.centery / SETTINGS.tile_size)]
 
         #check if player is out of bounds and teleport them back.
-        generator_check_list = [x for x in SETTINGS.walkable_area if x.map_pos == SETTINGS.player_map_pos]
-        if generator_check_list:
-            pos = generator_check_list[0].map_pos
-        else:
-            pos = []
-
-        check_list = SETTINGS.walkable_area + SETTINGS.all_solid_tiles
-        out_generator = [x for x in check_list if x.map_pos == SETTINGS.player_map_pos]
-        if out_generator:
-            pos2 = out_generator[0].map_pos
-        else:
-            pos2 = []
-            
+        column, row = SETTINGS.player_map_pos
+        inside_map = 0 <= row < len(SETTINGS.tile_grid) and 0 <= column < len(SETTINGS.tile_grid[row])
         
-        if SETTINGS.player_map_pos == pos:
+        if MAP.is_walkable(SETTINGS.player_map_pos):
             SETTINGS.last_player_map_pos = SETTINGS.player_map_pos
-            self.last_pos_tile = generator_check_list[0]
+            self.last_pos_tile = SETTINGS.tile_grid[row][column]
             
-        elif SETTINGS.player_map_pos != pos2 and SETTINGS.last_player_map_pos:
+        #Out of bounds is anywhere that is neither the walkable area nor a wall
+        elif not (inside_map and SETTINGS.tile_solid[SETTINGS.tile_grid[row][column].ID]) and SETTINGS.last_player_map_pos:
             if self.last_pos_tile:
                 SETTINGS.player_map_pos = SETTINGS.last_player_map_pos
                 self.rect.center = self.last_pos_tile.rect.center
                 SETTINGS.player_rect = self.rect
                 self.real_x = self.rect.x
                 self.real_y = self.rect.y
-            
-            
+
+        COLLISION.world.move(self)
             
 
     def draw(self, canvas):
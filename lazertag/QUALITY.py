@@ -0,0 +1,70 @@
+#Adaptive quality. Lowers or raises the ray count and draw distance to hold SETTINGS.fps.
+#Only SETTINGS.draw_distance is changed, so gameplay ranges that use SETTINGS.render stay the same.
+
+import SETTINGS
+
+class Controller:
+    '''== Adaptive quality controller ==\nThe graphics setting at start is the highest quality it goes to'''
+    def __init__(self):
+        self.levels = self.make_levels(SETTINGS.resolution, SETTINGS.render)
+        self.level = len(self.levels) - 1
+        if SETTINGS.adaptive_quality and len(self.levels) == 1:
+            print("[LASER TAG] Adaptive quality off: no lower ray count fills the %s px canvas like %s rays do" % (
+                SETTINGS.canvas_actual_width, SETTINGS.resolution))
+        self.slow_time = 0
+        self.fast_time = 0
+        self.cooldown = 0
+
+    def make_levels(self, resolution, render):
+        #Ray counts must keep the canvas width, so only those that fill it exactly are used
+        resolutions = [x for x in SETTINGS.quality_resolutions if SETTINGS.quality_min_resolution <= x < resolution
+                       and int(SETTINGS.canvas_target_width / x) * x == SETTINGS.canvas_actual_width]
+        resolutions = sorted(resolutions) + [resolution]
+
+        #Draw distance climbs with the ray count, from the lowest allowed up to the render setting
+        min_render = min(SETTINGS.quality_min_render, render)
+        levels = []
+        for index, rays in enumerate(resolutions):
+            if len(resolutions) > 1:
+                step = index / (len(resolutions) - 1)
+            else:
+                step = 1
+            levels.append((rays, int(round(min_render + (render - min_render) * step))))
+        return levels
+
+    def update(self, clock):
+        '''== Check the frame rate once per frame ==\nclock -> pygame Clock after tick()'''
+        if not SETTINGS.adaptive_quality:
+            return
+        if self.cooldown > 0:
+            self.cooldown -= SETTINGS.dt
+            return
+
+        #get_fps() is capped at the target, so the time spent before tick() waited tells if there is room to go up
+        fps = clock.get_fps()
+        busy = clock.get_rawtime() / (1000 / SETTINGS.fps)
+
+        if fps and fps < SETTINGS.fps * SETTINGS.quality_drop_fps:
+            self.slow_time += SETTINGS.dt
+        else:
+            self.slow_time = 0
+        if busy < SETTINGS.quality_raise_busy:
+            self.fast_time += SETTINGS.dt
+        else:
+            self.fast_time = 0
+
+        #Going down is quicker than going up, and every change is followed by a cooldown
+        if self.slow_time >= SETTINGS.quality_hold and self.level > 0:
+            self.set_level(self.level - 1, fps)
+        elif self.fast_time >= SETTINGS.quality_hold * 3 and self.level < len(self.levels) - 1:
+            self.set_level(self.level + 1, fps)
+
+    def set_level(self, level, fps):
+        old_rays, old_distance = self.levels[self.level]
+        self.level = level
+        SETTINGS.resolution, SETTINGS.draw_distance = self.levels[level]
+        self.slow_time = 0
+        self.fast_time = 0
+        self.cooldown = SETTINGS.quality_cooldown
+        print("[LASER TAG] Quality %s: %s -> %s rays, draw distance %s -> %s (%.0f fps)" % (
+            'raised' if SETTINGS.resolution > old_rays else 'lowered', old_rays, SETTINGS.resolution, old_distance, SETTINGS.draw_distance, fps))
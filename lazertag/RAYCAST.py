@@ -4,86 +4,95 @@ import SETTINGS
 import PLAYER
 import pygame
 import math
+import collections
+import concurrent.futures
+
+try:
+    import numpy
+except ImportError:
+    #The batch caster is optional. Without numpy, the 'python' backend is used.
+    numpy = None
 
 pygame.init()
 
+#Worker threads for strip rendering. Made on first use, remade when render_strips changes.
+render_pool = None
+render_pool_size = 0
+
+def run_strips(function, count):
+    '''== Split the screen into vertical strips ==\nrun_strips(function, count) -> [function(start, end) for each strip of range(count)]\nStrips run on the render pool when SETTINGS.render_strips > 1'''
+    global render_pool, render_pool_size
+    strips = max(1, min(SETTINGS.render_strips, count))
+    bounds = [count * strip // strips for strip in range(strips + 1)]
+    if strips == 1:
+        return [function(0, count)]
+
+    if render_pool is None or render_pool_size != strips:
+        if render_pool:
+            render_pool.shutdown(wait=False)
+        render_pool = concurrent.futures.ThreadPoolExecutor(max_workers=strips, thread_name_prefix='strip')
+        render_pool_size = strips
+    #The numpy and pygame calls in the strips let go of the GIL, and each strip writes its own columns
+    futures = [render_pool.submit(function, bounds[strip], bounds[strip+1]) for strip in range(strips)]
+    return [future.result() for future in futures]
+
 class Slice:
 
-    def __init__(self, location, surface, width, vh):
-        # LASER TAG FIX - Clamp offset and height to texture bounds to prevent crash
-        x_offset = location[0]
-        y_offset = location[1]
-        surface_width = surface.get_width()
-        surface_height = surface.get_height()
-
-        # Clamp x offset
-        if x_offset >= surface_width:
-            x_offset = surface_width - 1
-        if x_offset < 0:
-            x_offset = 0
-
-        # Clamp y offset and height
-        if y_offset < 0:
-            y_offset = 0
-        if y_offset >= surface_height:
-            y_offset = surface_height - 1
-
-        # Ensure slice height doesn't exceed texture bounds and is at least 1
-        slice_height = width
-        if y_offset + slice_height > surface_height:
-            slice_height = surface_height - y_offset
-        if slice_height < 1:
-            slice_height = 1
-
-        self.slice = surface.subsurface(pygame.Rect((x_offset, y_offset), (1, slice_height))).convert()
-        self.rect = self.slice.get_rect(center = (0, SETTINGS.canvas_target_height/2))
-        self.distance = None
+    def __init__(self, scaled_slice, distance, vh, xpos):
+        #scaled_slice comes from the SliceCache, already scaled, darkened and shaded
+        self.tempslice = scaled_slice
+        self.rect = scaled_slice.get_rect(center = (xpos, int(SETTINGS.canvas_target_height/2)))
+        self.distance = distance
         self.type = 'slice'
         self.vh = vh
-        self.xpos = 0
+        self.xpos = xpos
+
+
+class SliceCache:
+    '''== LRU cache of scaled wall columns ==\nmax_bytes -> Memory cap for the cached surfaces'''
+    def __init__(self, max_bytes):
+        self.surfaces = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, texture, offset, height, width, vh, band, shaded_textures):
+        #Heights are quantized so a player standing still (or moving slowly) reuses columns
+        bucket = SETTINGS.slice_cache_bucket
+        height = max(1, int(height / bucket + 0.5) * bucket)
+        key = (texture.ID, offset, height, width, vh, band)
+
+        if key in self.surfaces:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key]
+
+        self.misses += 1
+        surface = self.make_column(texture, shaded_textures[(band, vh)][texture.ID], offset, height, width)
+        self.surfaces[key] = surface
+        self.bytes += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            old_key, old_surface = self.surfaces.popitem(last = False)
+            self.bytes -= old_surface.get_width() * old_surface.get_height() * old_surface.get_bytesize()
+        return surface
+
+    def make_column(self, texture, surface, offset, height, width):
+        # LASER TAG FIX - Clamp offset and height to texture bounds to prevent crash
+        x_offset = min(max(texture.slices[offset], 0), surface.get_width() - 1)
+        slice_height = max(1, min(texture.rect.width, surface.get_height()))
 
-        if SETTINGS.shade:
-            self.shade_slice = pygame.Surface(self.slice.get_size()).convert_alpha()
-            sv = SETTINGS.shade_visibility / 10
-            self.shade_intensity = [sv*1, sv*2, sv*3, sv*4, sv*5, sv*6, sv*7, sv*8, sv*9, sv*10]
-        
-    def update_rect(self, new_slice):            
-        self.tempslice = new_slice
-        self.rect = new_slice.get_rect(center = (self.xpos, int(SETTINGS.canvas_target_height/2)))
+        column = surface.subsurface(pygame.Rect((x_offset, 0), (1, slice_height))).convert()
+        return pygame.transform.scale(column, (width, height))
 
-        if self.vh == 'v':
-            self.darkslice = pygame.Surface(self.tempslice.get_size()).convert_alpha()
-            self.darkslice.fill((0,0,0,SETTINGS.texture_darken))
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
 
-        if SETTINGS.shade:
-            #Shade intensity table
-            intensity = 0
-            if self.distance < self.shade_intensity[0]:
-                intensity = 0
-            elif self.distance < self.shade_intensity[1]:
-                intensity = 0.1
-            elif self.distance < self.shade_intensity[2]:
-                intensity = 0.2
-            elif self.distance < self.shade_intensity[3]:
-                intensity = 0.3
-            elif self.distance < self.shade_intensity[4]:
-                intensity = 0.4
-            elif self.distance < self.shade_intensity[5]:
-                intensity = 0.5
-            elif self.distance < self.shade_intensity[6]:
-                intensity = 0.6
-            elif self.distance < self.shade_intensity[7]:
-                intensity = 0.7
-            elif self.distance < self.shade_intensity[8]:
-                intensity = 0.8
-            elif self.distance < self.shade_intensity[9]:
-                intensity = 0.9
-            else:
-                intensity = 1
-            
-            self.shade_slice = pygame.Surface(self.tempslice.get_size()).convert_alpha()
-            self.shade_slice.fill((SETTINGS.shade_rgba[0]*intensity, SETTINGS.shade_rgba[1]*intensity,
-                                   SETTINGS.shade_rgba[2]*intensity, SETTINGS.shade_rgba[3]*intensity))
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
         
 
 class Raycast:
@@ -91,7 +100,7 @@ class Raycast:
     def __init__(self, canvas, canvas2):
         self.res = SETTINGS.resolution
         self.fov = SETTINGS.fov
-        self.render = SETTINGS.render
+        self.render = SETTINGS.draw_distance
         self.tile_size = SETTINGS.tile_size
         self.door_size = self.tile_size / 2
         self.wall_width = int(SETTINGS.canvas_target_width / self.res)
@@ -100,20 +109,75 @@ class Raycast:
 
         self.current_vtile = None
         self.current_htile = None
+        self.batch = None
+        self.slice_cache = SliceCache(SETTINGS.slice_cache_memory)
+        self.shaded_textures = {}
+        self.shade_bands = 1
+        self.atlas = None
         
 
     def calculate(self):
         self.res = SETTINGS.resolution
         self.fov = SETTINGS.fov
+        self.render = SETTINGS.draw_distance
+        self.wall_width = int(SETTINGS.canvas_target_width / self.res)
+
+        degrees, betas = self.ray_angles()
+        self.batch = None
+        SETTINGS.depth_buffer = [float('inf')] * len(degrees)
+
+        if numpy and SETTINGS.mode == 1 and SETTINGS.column_renderer:
+            #Walls are drawn later by draw_columns, so no Slices are made.
+            #The grid and doors are copied once here, the strips only read them.
+            self.update_grid()
+            strips = run_strips(lambda start, end: self.cast_batch(degrees[start:end], betas[start:end], update_grid=False), len(degrees))
+            self.batch = {key : numpy.concatenate([strip[key] for strip in strips]) for key in strips[0]}
+            SETTINGS.depth_buffer = numpy.where(self.batch['tile'] >= 0, self.batch['wall_dist'], numpy.inf)
+            self.set_middle_ray(self.batch)
+
+        elif SETTINGS.raycast_backend == 'numpy' and numpy:
+            batch = self.cast_batch(degrees, betas)
+            for ray_number in range(len(degrees)):
+                self.beta = betas[ray_number]
+                tile_index = batch['tile'][ray_number]
+                if tile_index >= 0:
+                    current_tile = self.grid_tiles[tile_index]
+                    texture = SETTINGS.tile_texture[current_tile.ID]
+                    tile_len = float(batch['distance'][ray_number])
+                    end_pos = (float(batch['end_x'][ray_number]), float(batch['end_y'][ray_number]))
+                else:
+                    current_tile = texture = tile_len = None
+                    end_pos = (SETTINGS.player_rect[0], SETTINGS.player_rect[1])
+                if batch['vh'][ray_number]:
+                    vh = 'v'
+                else:
+                    vh = 'h'
+                self.control(end_pos, ray_number, tile_len, SETTINGS.player_rect, texture, int(batch['offset'][ray_number]), current_tile, vh)
+
+        else:
+            for ray_number in range(len(degrees)):
+                self.beta = betas[ray_number]
+                self.cast(SETTINGS.player_rect, degrees[ray_number], ray_number)
+
+    def set_middle_ray(self, batch):
+        ray_number = int(self.res/2)
+        if batch['tile'][ray_number] >= 0:
+            SETTINGS.middle_slice_len = float(batch['wall_dist'][ray_number])
+            SETTINGS.middle_slice = self.grid_tiles[batch['tile'][ray_number]]
+            SETTINGS.middle_ray_pos = (float(batch['end_x'][ray_number]), float(batch['end_y'][ray_number]))
+        else:
+            SETTINGS.middle_slice_len = None
+            SETTINGS.middle_slice = None
+            SETTINGS.middle_ray_pos = (SETTINGS.player_rect[0], SETTINGS.player_rect[1])
+
+    def ray_angles(self):
+        #The angle of each ray and its angle to the view direction (beta)
         angle = SETTINGS.player_angle
-        
         step = self.fov / self.res
         fov = int(self.fov/2)
         ray = -fov
-        ray_number = 0
-
-        for tile in SETTINGS.all_solid_tiles:
-            tile.distance = tile.get_dist(SETTINGS.player_rect.center)
+        degrees = []
+        betas = []
 
         while ray < fov:
             degree = angle - ray
@@ -122,13 +186,11 @@ class Raycast:
             elif degree > 360:
                 degree -= 360
 
-            self.beta = abs(degree - angle)
-             
-            self.cast(SETTINGS.player_rect, degree, ray_number)
-
-            ray_number += 1
+            degrees.append(degree)
+            betas.append(abs(degree - angle))
             ray += step
 
+        return degrees, betas
 
     def find_offset(self, position, ray_number, angle, tile, hv):
         #position is H_x or V_y
@@ -149,175 +211,234 @@ class Raycast:
             offset = SETTINGS.tile_size - 1
         return(offset)
 
-    def check_hit(self, V_hit, H_hit, H_distance, V_distance, full_check):
-        #Break loop if any ray has hit a wall            
-        if H_hit and V_hit:
-            return True
-
-        elif full_check:
-            if H_hit:
-                if H_distance < V_distance:
-                    return True
+    def tile_at(self, column, row):
+        #O(1) lookup in the grid built by MAP.Map. Returns None outside the map.
+        if row < 0 or column < 0 or row >= len(SETTINGS.tile_grid) or column >= len(SETTINGS.tile_grid[row]):
+            return None
+        return SETTINGS.tile_grid[row][column]
 
-            elif V_hit:
-                if V_distance < H_distance:
-                    return True
-            
-
-    def cast(self, player_rect, angle, ray_number):
-        H_hit = False
-        V_hit = False
-        H_offset = V_offset = 0
-        end_pos = (0, 0)
-        angle -= 0.001
-
-        #Horizontal
+    def cast_horizontal(self, player_rect, angle, ray_number, tan):
+        #Walk the horizontal grid lines the ray crosses (DDA)
         if angle < 180:
             H_y = int(player_rect.center[1] / self.tile_size) * self.tile_size
+            step_y = -self.tile_size
+            row_shift = -1
         else:
             H_y = int(player_rect.center[1] / self.tile_size) * self.tile_size + self.tile_size
+            step_y = self.tile_size
+            row_shift = 0
+
+        H_x = player_rect.center[0] + (player_rect.center[1] - H_y) / tan
+        step_x = -step_y / tan
+
+        for x in range(0, SETTINGS.draw_distance):
+            tile = self.tile_at(int(H_x // self.tile_size), int(H_y / self.tile_size) + row_shift)
+            if tile == None:
+                return None
+
+            if SETTINGS.tile_visible[tile.ID]:
+                if tile.type == 'hdoor':
+                    #Doors are drawn half a tile further in
+                    door_x = H_x + step_x / 2
+                    offset = self.find_offset(door_x, ray_number, angle, tile, 'h')
+                    if offset >= 0:
+                        return (door_x, H_y + step_y / 2, offset, tile)
+                else:
+                    return (H_x, H_y, self.find_offset(H_x, ray_number, angle, tile, 'h'), tile)
+
+            H_y += step_y
+            H_x += step_x
 
-        H_x = player_rect.center[0] + (player_rect.center[1] - H_y) / math.tan(math.radians(angle))
+        return None
 
-        #Vertical
+    def cast_vertical(self, player_rect, angle, ray_number, tan):
+        #Walk the vertical grid lines the ray crosses (DDA)
         if angle > 270 or angle < 90:
             V_x = int(player_rect.center[0] / self.tile_size) * self.tile_size + self.tile_size
+            step_x = self.tile_size
+            column_shift = 0
         else:
             V_x = int(player_rect.center[0] / self.tile_size) * self.tile_size
-
-        V_y = player_rect.center[1] + (player_rect.center[0] - V_x) * math.tan(math.radians(angle))
-
-        #Extend
-        for x in range(0, SETTINGS.render):
-            
-            H_distance = abs((player_rect.center[0] - H_x) / math.cos(math.radians(angle)))
-            V_distance = abs((player_rect.center[0] - V_x) / math.cos(math.radians(angle)))
-
-            if self.check_hit(V_hit, H_hit, H_distance, V_distance, True):
-                break
-                
-            for tile in SETTINGS.rendered_tiles:
-                
-                if self.check_hit(V_hit, H_hit, H_distance, V_distance, False):
-                    break
-                
-                if not H_hit:
-                    if (H_y == tile.rect.bottom and H_x >= tile.rect.bottomleft[0] and H_x <= tile.rect.bottomright[0]) and player_rect.centery > tile.rect.bottom:
-                        H_hit = True
-                        H_texture = SETTINGS.tile_texture[tile.ID]
-                        self.current_htile = tile
-                        if tile.type == 'hdoor':
-                            H_y -= self.door_size
-                            H_x += self.door_size / math.tan(math.radians(angle))
-                            H_offset = offset = self.find_offset(H_x, ray_number, angle, tile, 'h')
-                            if H_offset < 0:
-                                H_hit = False
-                                H_y += self.door_size
-                                H_x -= self.door_size / math.tan(math.radians(angle))
-                        else:
-                            H_offset = offset = self.find_offset(H_x, ray_number, angle, tile, 'h')
-                            
-                    elif (H_y == tile.rect.top and H_x >= tile.rect.topleft[0] and H_x <= tile.rect.topright[0]) and player_rect.centery < tile.rect.top:
-                        H_hit = True
-                        H_texture = SETTINGS.tile_texture[tile.ID]
-                        self.current_htile = tile
-                        if tile.type == 'hdoor':
-                            H_y += self.door_size
-                            H_x -= self.door_size / math.tan(math.radians(angle))
-                            H_offset = offset = self.find_offset(H_x, ray_number, angle, tile, 'h')
-                            if H_offset < 0:
-                                H_hit = False
-                                H_y -= self.door_size
-                                H_x += self.door_size / math.tan(math.radians(angle))
-                        else:
-                            H_offset = self.find_offset(H_x, ray_number, angle, tile, 'h')
-                                
-                if self.check_hit(V_hit, H_hit, H_distance, V_distance, False):
-                    break      
-                        
-                if not V_hit:
-                    if (V_x == tile.rect.left and V_y >= tile.rect.topleft[1] and V_y <= tile.rect.bottomleft[1]) and player_rect.centerx < tile.rect.left:
-                        V_hit = True
-                        V_texture = SETTINGS.tile_texture[tile.ID]
-                        self.current_vtile = tile
-                        if tile.type == 'vdoor':
-                            V_x += self.door_size
-                            V_y -= self.door_size * math.tan(math.radians(angle))
-                            V_offset = self.find_offset(V_y, ray_number, angle, tile, 'v')
-                            if V_offset < 0:
-                               V_hit = False
-                               V_x -= self.door_size
-                               V_y += self.door_size * math.tan(math.radians(angle))
-                        else:
-                            V_offset = self.find_offset(V_y, ray_number, angle, tile, 'v')
-                            
-                    elif (V_x == tile.rect.right and V_y >= tile.rect.topright[1] and V_y <= tile.rect.bottomright[1]) and player_rect.centerx > tile.rect.right:
-                        V_hit = True
-                        V_texture = SETTINGS.tile_texture[tile.ID]
-                        self.current_vtile = tile
-                        if tile.type == 'vdoor':
-                            V_x -= self.door_size
-                            V_y += self.door_size * math.tan(math.radians(angle))
-                            V_offset = self.find_offset(V_y, ray_number, angle, tile, 'v')
-                            if V_offset < 0:
-                               V_hit = False
-                               V_x += self.door_size
-                               V_y -= self.door_size * math.tan(math.radians(angle))
-                        else:
-                            V_offset = self.find_offset(V_y, ray_number, angle, tile, 'v')
-                               
-            #Extend actual ray
-            if not H_hit:
-                if angle < 180:
-                    H_y -= self.tile_size
+            step_x = -self.tile_size
+            column_shift = -1
+
+        V_y = player_rect.center[1] + (player_rect.center[0] - V_x) * tan
+        step_y = -step_x * tan
+
+        for x in range(0, SETTINGS.draw_distance):
+            tile = self.tile_at(int(V_x / self.tile_size) + column_shift, int(V_y // self.tile_size))
+            if tile == None:
+                return None
+
+            if SETTINGS.tile_visible[tile.ID]:
+                if tile.type == 'vdoor':
+                    door_y = V_y + step_y / 2
+                    offset = self.find_offset(door_y, ray_number, angle, tile, 'v')
+                    if offset >= 0:
+                        return (V_x + step_x / 2, door_y, offset, tile)
                 else:
-                    H_y += self.tile_size
-                if angle >= 180:
-                    H_x -= self.tile_size / math.tan(math.radians(angle))
+                    return (V_x, V_y, self.find_offset(V_y, ray_number, angle, tile, 'v'), tile)
+
+            V_x += step_x
+            V_y += step_y
+
+        return None
+
+    def build_grid_arrays(self):
+        #Copy SETTINGS.tile_grid into numpy arrays for the batch caster.
+        rows = len(SETTINGS.tile_grid)
+        columns = max(len(row) for row in SETTINGS.tile_grid)
+        #kind: -1 = outside map, 0 = see-through, 1 = wall, 2 = hdoor, 3 = vdoor
+        self.grid_kind = numpy.full((rows, columns), -1, dtype=numpy.int8)
+        self.grid_index = numpy.full((rows, columns), -1, dtype=numpy.int32)
+        self.grid_open = numpy.zeros((rows, columns))
+        self.grid_tiles = []
+        self.grid_doors = []
+
+        for row in range(rows):
+            for column in range(len(SETTINGS.tile_grid[row])):
+                tile = SETTINGS.tile_grid[row][column]
+                self.grid_index[row, column] = len(self.grid_tiles)
+                self.grid_tiles.append(tile)
+                if not SETTINGS.tile_visible[tile.ID]:
+                    self.grid_kind[row, column] = 0
+                elif tile.type == 'hdoor':
+                    self.grid_kind[row, column] = 2
+                    self.grid_doors.append(tile)
+                elif tile.type == 'vdoor':
+                    self.grid_kind[row, column] = 3
+                    self.grid_doors.append(tile)
                 else:
-                    H_x += self.tile_size / math.tan(math.radians(angle))                
+                    self.grid_kind[row, column] = 1
+
+        #Tile ID per grid index, for picking wall textures in draw_columns
+        self.grid_ids = numpy.array([tile.ID for tile in self.grid_tiles], dtype=numpy.int64)
+        self.grid_source = SETTINGS.tile_grid
+
+    def update_grid(self):
+        #Rebuild the grid arrays (and tile IDs) for a new map and copy in how far each door is open
+        if getattr(self, 'grid_source', None) is not SETTINGS.tile_grid:
+            self.build_grid_arrays()
+        for door in self.grid_doors:
+            self.grid_open[door.map_pos[1], door.map_pos[0]] = door.open
+
+    def walk_batch(self, start_x, start_y, step_x, step_y, row_shift, column_shift, door_kind, horizontal):
+        #Walk all rays along one set of grid lines at once. Returns hit position, offset and tile index per ray.
+        rays = len(start_x)
+        rows, columns = self.grid_kind.shape
+        pos_x = start_x.copy()
+        pos_y = start_y.copy()
+        hit_x = numpy.zeros(rays)
+        hit_y = numpy.zeros(rays)
+        offset = numpy.zeros(rays, dtype=numpy.int32)
+        tile = numpy.full(rays, -1, dtype=numpy.int32)
+        active = numpy.ones(rays, dtype=bool)
+
+        for x in range(0, SETTINGS.draw_distance):
+            column = numpy.floor(pos_x / self.tile_size).astype(numpy.int64) + column_shift
+            row = numpy.floor(pos_y / self.tile_size).astype(numpy.int64) + row_shift
+            active &= (row >= 0) & (row < rows) & (column >= 0) & (column < columns)
+            if not active.any():
+                break
 
-            if not V_hit:
-                if angle > 270 or angle < 90: # ->
-                    V_x += self.tile_size
-                else:
-                    V_x -= self.tile_size
-                if angle >= 270 or angle < 90: # <-
-                    V_y -= self.tile_size * math.tan(math.radians(angle))
-                else:
-                    V_y += self.tile_size * math.tan(math.radians(angle))
-
-
-        if V_hit and H_hit:
-            H_hit, V_hit = False, False
-            if H_distance < V_distance:
-                end_pos = (H_x, H_y)
-                texture = H_texture
-                tile_len = H_distance
-                offset = H_offset
-                current_tile = self.current_htile
-                H_hit = True
+            kind = numpy.full(rays, -1, dtype=numpy.int8)
+            kind[active] = self.grid_kind[row[active], column[active]]
+            active &= kind != -1
+
+            #Doors are hit half a tile further in, and only where they are not open
+            door = active & (kind == door_kind)
+            wall = active & (kind > 0) & ~door
+            end_x = numpy.where(door, pos_x + step_x / 2, pos_x)
+            end_y = numpy.where(door, pos_y + step_y / 2, pos_y)
+            if horizontal:
+                along, tile_edge = end_x, column * self.tile_size
             else:
-                end_pos = (V_x, V_y)
-                texture = V_texture
-                tile_len = V_distance
-                offset = V_offset
-                current_tile = self.current_vtile
-                V_hit = True
-
-        elif H_hit and not V_hit:
-            end_pos = (H_x, H_y)
-            texture = H_texture
+                along, tile_edge = end_y, row * self.tile_size
+            ray_offset = numpy.abs(numpy.trunc(along - tile_edge))
+            if door.any():
+                ray_offset[door] -= self.grid_open[row[door], column[door]]
+                door &= ray_offset >= 0
+
+            hit = wall | door
+            hit_x[hit] = end_x[hit]
+            hit_y[hit] = end_y[hit]
+            offset[hit] = numpy.minimum(ray_offset[hit], self.tile_size - 1).astype(numpy.int32)
+            tile[hit] = self.grid_index[row[hit], column[hit]]
+            active &= ~hit
+
+            pos_x += step_x
+            pos_y += step_y
+
+        return hit_x, hit_y, offset, tile
+
+    def cast_batch(self, degrees, betas, update_grid=True):
+        '''== Cast all rays at once with numpy ==\ncast_batch(degrees, betas, update_grid) -> dict of per-column arrays\ndistance, wall_dist, vh, offset, tile, end_x, end_y\nupdate_grid=False uses the grid arrays as they are (strips, after one update_grid)'''
+        if update_grid:
+            self.update_grid()
+
+        px, py = SETTINGS.player_rect.center
+        angles = numpy.array(degrees) - 0.001
+        tan = numpy.tan(numpy.radians(angles))
+
+        #Horizontal grid lines
+        up = angles < 180
+        H_y = numpy.where(up, int(py / self.tile_size) * self.tile_size, int(py / self.tile_size) * self.tile_size + self.tile_size).astype(float)
+        H_x = px + (py - H_y) / tan
+        H_step_y = numpy.where(up, -self.tile_size, self.tile_size).astype(float)
+        H = self.walk_batch(H_x, H_y, -H_step_y / tan, H_step_y, numpy.where(up, -1, 0), 0, 2, True)
+
+        #Vertical grid lines
+        right = (angles > 270) | (angles < 90)
+        V_x = numpy.where(right, int(px / self.tile_size) * self.tile_size + self.tile_size, int(px / self.tile_size) * self.tile_size).astype(float)
+        V_y = py + (px - V_x) * tan
+        V_step_x = numpy.where(right, self.tile_size, -self.tile_size).astype(float)
+        V = self.walk_batch(V_x, V_y, V_step_x, -V_step_x * tan, 0, numpy.where(right, 0, -1), 3, False)
+
+        H_distance = numpy.where(H[3] >= 0, numpy.hypot(H[0] - px, H[1] - py), numpy.inf)
+        V_distance = numpy.where(V[3] >= 0, numpy.hypot(V[0] - px, V[1] - py), numpy.inf)
+        use_h = H_distance < V_distance
+
+        distance = numpy.where(use_h, H_distance, V_distance)
+        hit = numpy.isfinite(distance)
+        distance[~hit] = numpy.nan
+
+        return {
+            'distance': distance,
+            'wall_dist': distance * numpy.cos(numpy.radians(betas)),
+            'vh': ~use_h & hit,
+            'offset': numpy.where(use_h, H[2], V[2]),
+            'tile': numpy.where(use_h, H[3], numpy.where(hit, V[3], -1)),
+            'end_x': numpy.where(use_h, H[0], V[0]),
+            'end_y': numpy.where(use_h, H[1], V[1]),
+            }
+
+    def cast(self, player_rect, angle, ray_number):
+        angle -= 0.001
+        tan = math.tan(math.radians(angle))
+
+        H_hit = self.cast_horizontal(player_rect, angle, ray_number, tan)
+        V_hit = self.cast_vertical(player_rect, angle, ray_number, tan)
+
+        if H_hit:
+            H_distance = math.hypot(H_hit[0] - player_rect.center[0], H_hit[1] - player_rect.center[1])
+        if V_hit:
+            V_distance = math.hypot(V_hit[0] - player_rect.center[0], V_hit[1] - player_rect.center[1])
+
+        if H_hit and (not V_hit or H_distance < V_distance):
+            end_pos = (H_hit[0], H_hit[1])
+            offset = H_hit[2]
+            current_tile = self.current_htile = H_hit[3]
+            texture = SETTINGS.tile_texture[current_tile.ID]
             tile_len = H_distance
-            offset = H_offset
-            current_tile = self.current_htile
+            vh = 'h'
 
-        elif V_hit and not H_hit:
-            end_pos = (V_x, V_y)
-            texture = V_texture
+        elif V_hit:
+            end_pos = (V_hit[0], V_hit[1])
+            offset = V_hit[2]
+            current_tile = self.current_vtile = V_hit[3]
+            texture = SETTINGS.tile_texture[current_tile.ID]
             tile_len = V_distance
-            offset = V_offset
-            current_tile = self.current_vtile
+            vh = 'v'
 
         else:
             end_pos = (SETTINGS.player_rect[0],SETTINGS.player_rect[1])
@@ -325,10 +446,6 @@ class Raycast:
             tile_len = None
             offset = 0
             current_tile = None
-
-        if V_hit:
-            vh = 'v'
-        else:
             vh = 'h'
             
         #Mode
@@ -351,11 +468,11 @@ class Raycast:
     def render_screen(self, ray_number, wall_dist, texture, offset, current_tile, vh, end_pos):
         if wall_dist:
             wall_height = int((self.tile_size / wall_dist) * (360 / math.tan(math.radians(SETTINGS.fov * 0.8))))
-            SETTINGS.zbuffer.append(Slice((texture.slices[offset], 0), texture.texture, texture.rect.width, vh))
-            SETTINGS.zbuffer[ray_number].distance = wall_dist
-            rendered_slice = pygame.transform.scale(SETTINGS.zbuffer[ray_number].slice, (self.wall_width, wall_height))
-            SETTINGS.zbuffer[ray_number].update_rect(rendered_slice)
-            SETTINGS.zbuffer[ray_number].xpos = ((ray_number) * self.wall_width)
+            if not self.shaded_textures:
+                self.build_shade_tables()
+            rendered_slice = self.slice_cache.get(texture, offset, wall_height, self.wall_width, vh, self.shade_band(wall_dist), self.shaded_textures)
+            SETTINGS.zbuffer.append(Slice(rendered_slice, wall_dist, vh, ray_number * self.wall_width))
+            SETTINGS.depth_buffer[ray_number] = wall_dist
 
         else:
             SETTINGS.zbuffer.append(None)
@@ -367,6 +484,125 @@ class Raycast:
             SETTINGS.middle_ray_pos = end_pos
             
 
+    def shade_band(self, wall_dist):
+        #0 = no shade, 10 = full shade colour. Each band is shade_visibility / 10 deep.
+        if not SETTINGS.shade:
+            return 0
+        return min(int(wall_dist / (SETTINGS.shade_visibility / 10)), self.shade_bands - 1)
+
+    def build_shade_tables(self):
+        '''== Pre-shade every wall texture ==\nOne variant per shade band and wall side. Called when a level is loaded.'''
+        if SETTINGS.shade:
+            bands = 11
+        else:
+            bands = 1
+        self.shade_bands = bands
+
+        darkslice = pygame.Surface((self.tile_size, self.tile_size)).convert_alpha()
+        darkslice.fill((0,0,0,SETTINGS.texture_darken))
+        self.shaded_textures = {}
+
+        for band in range(bands):
+            intensity = band / 10
+            shade_slice = pygame.Surface((self.tile_size, self.tile_size)).convert_alpha()
+            shade_slice.fill((SETTINGS.shade_rgba[0]*intensity, SETTINGS.shade_rgba[1]*intensity,
+                              SETTINGS.shade_rgba[2]*intensity, SETTINGS.shade_rgba[3]*intensity))
+            for vh in ('h', 'v'):
+                variants = {}
+                for ID, texture in SETTINGS.tile_texture.items():
+                    #Sprite tiles have no wall texture
+                    if not hasattr(texture, 'slices'):
+                        continue
+                    shaded = texture.texture.copy()
+                    if vh == 'v':
+                        #Make vertical walls slightly darker
+                        shaded.blit(pygame.transform.scale(darkslice, shaded.get_size()), (0, 0))
+                    if band:
+                        shaded.blit(pygame.transform.scale(shade_slice, shaded.get_size()), (0, 0))
+                    variants[ID] = shaded
+                self.shaded_textures[(band, vh)] = variants
+
+        self.slice_cache.clear()
+        if numpy:
+            self.build_texture_atlas(bands)
+
+    def build_texture_atlas(self, bands):
+        #Pixel arrays of the shaded textures: [band, side (0 = h, 1 = v), tile ID, x, y]
+        self.atlas = numpy.zeros((bands, 2, len(SETTINGS.tile_texture), self.tile_size, self.tile_size, 3), dtype=numpy.uint8)
+        for (band, vh), variants in self.shaded_textures.items():
+            for ID, surface in variants.items():
+                pixels = pygame.surfarray.array3d(surface)
+                #Textures of another size are resampled to tile_size
+                xs = numpy.arange(self.tile_size) * pixels.shape[0] // self.tile_size
+                ys = numpy.arange(self.tile_size) * pixels.shape[1] // self.tile_size
+                self.atlas[band, int(vh == 'v'), ID] = pixels[xs][:, ys]
+
+    def draw_columns(self, canvas):
+        '''== Draw the walls straight into the canvas pixels ==\ndraw_columns(canvas) -> Uses the arrays from the last calculate()'''
+        if self.batch is None:
+            return
+        if self.atlas is None:
+            self.build_shade_tables()
+
+        batch = self.batch
+        width, height = canvas.get_size()
+        hit = batch['tile'] >= 0
+        wall_dist = numpy.where(hit, batch['wall_dist'], 1)
+        wall_height = ((self.tile_size / wall_dist) * (360 / math.tan(math.radians(SETTINGS.fov * 0.8)))).astype(numpy.int64)
+        wall_height = numpy.maximum(wall_height, 1)
+        top = int(SETTINGS.canvas_target_height/2) - wall_height // 2
+
+        #Texture column of each ray, taken from the pre-shaded variant for its side and distance
+        ids = self.grid_ids[numpy.maximum(batch['tile'], 0)]
+        if SETTINGS.shade:
+            band = numpy.minimum((wall_dist / (SETTINGS.shade_visibility / 10)).astype(numpy.int64), self.shade_bands - 1)
+        else:
+            band = 0
+        columns = self.atlas[band, batch['vh'].astype(numpy.int64), ids, batch['offset']]
+
+        if not hit.any():
+            return
+        #Work on mapped pixel values (one int per pixel) instead of RGB triplets
+        mapped = pygame.surfarray.map_array(canvas, columns)
+
+        pixels = pygame.surfarray.pixels2d(canvas)
+        run_strips(lambda start, end: self.draw_strip(pixels, mapped, hit, top, wall_height, start, end), len(hit))
+        del pixels
+
+    def draw_strip(self, pixels, mapped, hit, top, wall_height, start, end):
+        #Draw the walls of rays start to end into their screen columns
+        hit = hit[start:end]
+        top = top[start:end]
+        wall_height = wall_height[start:end]
+        if not hit.any():
+            return
+
+        #Only the rows some wall reaches are touched
+        first_row = max(0, int(top[hit].min()))
+        last_row = min(pixels.shape[1], int((top + wall_height)[hit].max()))
+        if first_row >= last_row:
+            return
+
+        #Texture row for every screen row of every ray. Same sampling as transform.scale.
+        rel = numpy.arange(first_row, last_row, dtype=numpy.int32)[None, :] - top[:, None].astype(numpy.int32)
+        mask = hit[:, None] & (rel >= 0) & (rel < wall_height[:, None])
+        texture_y = numpy.clip(rel * self.tile_size // wall_height[:, None].astype(numpy.int32), 0, self.tile_size - 1)
+        texture_y += (numpy.arange(len(hit), dtype=numpy.int32) * self.tile_size)[:, None]
+        colours = mapped[start:end].reshape(-1).take(texture_y)
+
+        x_start, x_end, column_ray = self.strip_columns(start, end, len(mapped), pixels.shape[0])
+        numpy.copyto(pixels[x_start:x_end, first_row:last_row], colours[column_ray], where=mask[column_ray], casting='unsafe')
+
+    def strip_columns(self, start, end, rays, width):
+        #Screen columns covered by rays start to end. Each ray covers wall_width columns and the last one takes what is left.
+        x_start = min(start * self.wall_width, width)
+        if end == rays:
+            x_end = width
+        else:
+            x_end = min(end * self.wall_width, width)
+        column_ray = numpy.minimum(numpy.arange(x_start, x_end) // self.wall_width, rays - 1) - start
+        return x_start, x_end, column_ray
+
     def draw_line(self, player_rect, end_pos):
         SETTINGS.raylines.append((player_rect.center, end_pos))
 
@@ -51,12 +51,43 @@ screen_shake = 0
 resolution = 1280  # Full native resolution - 1:1 pixel mapping for sharpest quality
 fov = 60
 render = 16
+#How far walls and sprites are drawn, in tiles. Starts at render and only the quality controller changes it.
+#Gameplay ranges (NPC sight, attacks, sounds) keep using render.
+draw_distance = 16
 shade = False
 shade_rgba = (0,0,0,255)
 shade_visibility = 1000
+#'python' casts ray by ray, 'numpy' casts every column at once (needs numpy)
+raycast_backend = 'numpy'
+#Draw walls straight into the canvas pixels instead of making a Slice per ray (needs numpy)
+column_renderer = True
+#Scaled wall columns cache for the Slice renderer: memory cap in bytes and height step in px
+slice_cache_memory = 32 * 1024 * 1024
+slice_cache_bucket = 2
+#Perspective textured floor and ceiling (needs numpy). Costs a few ms a frame, so it is off by default
+#and the textures are tiled flat.
+floor_casting = False
+#Vertical screen strips cast and drawn in parallel on a thread pool. 1 renders on the main thread.
+render_strips = 1
+#Adaptive quality: lower the rays and draw distance when fps drops below quality_drop_fps * fps,
+#raise them again when a frame uses less than quality_raise_busy of its time. Times are in seconds.
+adaptive_quality = True
+quality_resolutions = (64, 80, 128, 160, 256, 320, 640, 1280)
+quality_min_resolution = 128
+quality_min_render = 8
+quality_drop_fps = 0.9
+quality_raise_busy = 0.5
+quality_hold = 1
+quality_cooldown = 2
+
+#Scaled sprite cache: memory cap in bytes and height step in px
+sprite_cache_memory = 32 * 1024 * 1024
+sprite_cache_bucket = 2
 
 #Below this point are the non-configurable raycasting variables.
-zbuffer = []
+zbuffer = [] #Wall Slices, one per ray
+depth_buffer = [] #Wall distance per ray. Sprites are depth tested against it.
+sprite_list = [] #Sprites on screen this frame
 middle_slice_len = None
 middle_slice = None
 middle_ray_pos = None
@@ -67,11 +98,14 @@ raylines = []
 tile_size = 64
 #Below this point are the non-configurable tile variables.
 all_tiles = []
+tile_grid = []
 trigger_tiles = []
 all_solid_tiles = []
-rendered_tiles = []
 walkable_area = []
+tile_components = [] #[row][column] connected area of walkable tiles, 0 is the walkable area. None for walls.
 all_doors = []
+door_grid = {} #(column, row) : door tile
+active_doors = [] #Doors that are opening, open or closing
 end_angle = 0
 
 
@@ -128,7 +162,24 @@ ground_weapon = None
 '''NPC settings'''
 #NPC information goes here
 ignore_player = False
+#AI level of detail: NPCs within ai_near_distance tiles, fighting or in sight on screen think every frame, others every
+#ai_mid_interval seconds, or ai_far_interval when dead or out of range. ai_budget is ms per frame for the slower ones,
+#the most overdue one always thinks. One think uses at most ai_max_dt seconds, the rest is carried over.
+ai_near_distance = 6
+ai_mid_interval = 0.1
+ai_far_interval = 0.25
+ai_budget = 4
+ai_max_dt = 0.5
+#ms per frame for serving NPC path requests. At least one is served every frame.
+path_budget = 2
+#Found paths kept for reuse. Cleared when a level is loaded.
+path_cache_size = 256
+#Levels with at most this many walkable tiles get a table of the next step from every tile to every tile.
+#Paths are then read from it without searching. Cached in data/cache.
+next_hop_max_tiles = 400
 #Below this point are non-configurable variables.
+#'astar' or 'jps' (jump point search), set from the level
+pathfinding = 'astar'
 npc_list = []
 npc_types = []
 npc_soundpacks = []
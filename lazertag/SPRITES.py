@@ -1,9 +1,128 @@
 import pygame
 import math
+import collections
 import SETTINGS
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
  # I noticed, that the sprites are not projected correctly. However, I do not have the guts to fix it. Feel free to take a look.
 
+class ScaleCache:
+    '''== LRU cache of scaled sprites ==\nmax_bytes -> Memory cap for the cached surfaces'''
+    def __init__(self, max_bytes):
+        self.surfaces = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, texture, width, height):
+        #The texture is kept in the entry, so a new surface that got the id of a freed one is not mistaken for it
+        key = (id(texture), width, height)
+        entry = self.surfaces.get(key)
+        if entry and entry[0] is texture:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        surface = pygame.transform.scale(texture, (width, height))
+        size = width * height * surface.get_bytesize()
+        #Sprites right in front of the player are too big to be worth keeping
+        if size <= self.max_bytes / 4:
+            if entry:
+                self.bytes -= entry[1].get_width() * entry[1].get_height() * entry[1].get_bytesize()
+            self.surfaces[key] = (texture, surface)
+            self.surfaces.move_to_end(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+                old_key, (old_texture, old_surface) = self.surfaces.popitem(last = False)
+                self.bytes -= old_surface.get_width() * old_surface.get_height() * old_surface.get_bytesize()
+        return surface
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+#Shared by every sprite, NPC animation frames included
+scale_cache = ScaleCache(SETTINGS.sprite_cache_memory)
+
+class Projection:
+    '''== Batched sprite projection ==\nKeeps the sprite positions in numpy arrays and projects every sprite in one pass'''
+    def __init__(self):
+        self.sprites = []
+        self.slots = {}
+        self.positions = None
+        self.sizes = None
+
+    def rebuild(self):
+        #SETTINGS.all_sprites changed (new level, item picked up), so the arrays are made again
+        self.sprites = list(SETTINGS.all_sprites)
+        self.slots = {id(sprite) : slot for slot, sprite in enumerate(self.sprites)}
+        self.positions = numpy.array([sprite.rect.center for sprite in self.sprites], dtype=float).reshape(-1, 2)
+        self.sizes = numpy.array([sprite.rect.size for sprite in self.sprites], dtype=float).reshape(-1, 2)
+
+    def moved(self, sprite):
+        slot = self.slots.get(id(sprite))
+        if slot is not None and self.sprites[slot] is sprite:
+            self.positions[slot] = sprite.rect.center
+
+    def project(self):
+        '''== Project all sprites ==\nSame maths as Sprite.get_pos, for every sprite at once. Fills SETTINGS.sprite_list.'''
+        if self.sprites != SETTINGS.all_sprites:
+            self.rebuild()
+        if not self.sprites:
+            return
+        angle = SETTINGS.player_angle
+        fov = SETTINGS.fov
+
+        xpos = self.positions[:, 0] - SETTINGS.player_rect[0]
+        ypos = SETTINGS.player_rect[1] - self.positions[:, 1]
+        dist = numpy.sqrt(xpos*xpos + ypos*ypos)
+        dist[dist == 0] = 0.0001
+
+        theta = numpy.degrees(numpy.arctan2(ypos, xpos))
+        theta[theta < 0] += 360
+
+        yTmp = angle + (fov/2) - theta
+        if angle < 90:
+            yTmp[theta > 270] += 360
+        if angle > 270:
+            yTmp[theta < 90] -= 360
+        xTmp = yTmp * SETTINGS.canvas_actual_width / fov
+
+        sprite_height = ((self.sizes[:, 1] / dist) * (100 / math.tan(math.radians(fov * 0.8)))).astype(numpy.int64)
+        sprite_height = numpy.minimum(sprite_height, 2500)
+        bucket = SETTINGS.sprite_cache_bucket
+        sprite_height = (sprite_height / bucket + 0.5).astype(numpy.int64) * bucket
+        sprite_width = (self.sizes[:, 0] / self.sizes[:, 1] * sprite_height).astype(numpy.int64)
+
+        for sprite, values in zip(self.sprites, zip(dist.tolist(), theta.tolist(), xTmp.tolist(), sprite_width.tolist(), sprite_height.tolist())):
+            sprite.set_projection(*values)
+
+#Shared by every sprite
+projection = Projection()
+
+def project_sprites(canvas):
+    '''== Project every sprite for this frame ==\nBatched with numpy when it is there'''
+    if numpy is not None:
+        projection.project()
+    else:
+        for sprite in SETTINGS.all_sprites:
+            sprite.get_pos(canvas)
+
+def depth_from_zbuffer(zbuffer):
+    '''== Wall distance per ray from a zbuffer of Slices ==\nRays without a Slice see no wall'''
+    return [item.distance if item else float('inf') for item in zbuffer]
+
 class Sprite:
     '''== Create a sprite ==\ntexture -> loaded texture | ID -> unique\npos -> px coords          | texture_type -> sprite, npc'''
     def __init__(self, texture, ID, pos, texture_type, parent = None):
@@ -19,6 +138,8 @@ class Sprite:
         self.rect.centery = pos[1]
 
         self.new_rect = None
+        self.new_size = None
+        self.drawable = False
         self.distance = None
 
         self.theta = None
@@ -43,14 +164,11 @@ class Sprite:
         dist = math.sqrt(xpos*xpos + ypos*ypos)
         if dist == 0:
             dist += 0.0001
-        self.distance = dist
 
         thetaTemp = math.atan2(ypos, xpos)
         thetaTemp = math.degrees(thetaTemp)
         if thetaTemp < 0:
             thetaTemp += 360
-            
-        self.theta = thetaTemp
 
         yTmp = angle + (fov/2) - thetaTemp
         if thetaTemp > 270 and angle < 90:
@@ -63,11 +181,20 @@ class Sprite:
         sprite_height = int((self.rect.height / dist) * (100 / math.tan(math.radians(fov * 0.8))))
         if sprite_height > 2500:
             sprite_height = 2500
+        #Heights are quantized so the scaled sprite can be reused while it barely moves
+        bucket = SETTINGS.sprite_cache_bucket
+        sprite_height = int(sprite_height / bucket + 0.5) * bucket
 
         sprite_width = int(self.rect.width / self.rect.height * sprite_height)
-        
-        if xTmp > (0 - sprite_width) and xTmp < (SETTINGS.canvas_actual_width + sprite_width):
-            SETTINGS.zbuffer.append(self)
+        self.set_projection(dist, thetaTemp, xTmp, sprite_width, sprite_height)
+
+    def set_projection(self, dist, theta, xTmp, sprite_width, sprite_height):
+        #Store where the sprite lands on screen and put it in the draw list if it is on screen
+        self.distance = dist
+        self.theta = theta
+        on_screen = xTmp > (0 - sprite_width) and xTmp < (SETTINGS.canvas_actual_width + sprite_width)
+        if on_screen:
+            SETTINGS.sprite_list.append(self)
             
             if self.parent:
                 self.parent.in_canvas = True
@@ -75,19 +202,68 @@ class Sprite:
             if self.parent:
                 self.parent.in_canvas = False
 
-        self.new_size = pygame.transform.scale(self.texture, (sprite_width, sprite_height))
-        self.new_rect = self.new_size.get_rect()
+        #The rect is still needed for hit detection. Scaling waits until draw() knows some of the sprite is visible.
+        self.new_size = None
+        self.drawable = on_screen and dist < SETTINGS.draw_distance * SETTINGS.tile_size and sprite_height > 0
+        self.new_rect = pygame.Rect(0, 0, sprite_width, sprite_height)
         self.new_rect.center = (xTmp, SETTINGS.canvas_target_height/2)
         if self.parent:
             self.parent.hit_rect = self.new_rect
 
-    def draw(self, canvas):
+    def draw(self, canvas, depth_buffer=None):
+        '''== Draw the sprite ==\ndepth_buffer -> wall distance per ray, or the zbuffer of Slices. Only columns in front of the wall are drawn.'''
         # No team outlines in laser tag mode - all NPCs blend in
-        canvas.blit(self.new_size, self.new_rect)
+        if not self.drawable:
+            return
+        if depth_buffer is None:
+            runs = [(max(0, self.new_rect.left), min(SETTINGS.canvas_actual_width, self.new_rect.right))]
+        else:
+            runs = self.visible_runs(depth_buffer)
+        #Hidden sprites are never scaled
+        if not runs:
+            return
+
+        self.new_size = scale_cache.get(self.texture, self.new_rect.width, self.new_rect.height)
+        for run_start, run_end in runs:
+            canvas.blit(self.new_size, (run_start, self.new_rect.y), (run_start - self.new_rect.x, 0, run_end - run_start, self.new_rect.height))
+
+    def visible_runs(self, depth_buffer):
+        #Screen x ranges where the sprite is nearer than the wall in that column
+        #A zbuffer holds Slices, or None where no wall was hit, instead of distances
+        if isinstance(depth_buffer, list) and depth_buffer and (depth_buffer[0] is None or hasattr(depth_buffer[0], 'tempslice')):
+            depth_buffer = depth_from_zbuffer(depth_buffer)
+        wall_width = int(SETTINGS.canvas_target_width / SETTINGS.resolution)
+        first = max(0, self.new_rect.left)
+        last = min(SETTINGS.canvas_actual_width, self.new_rect.right)
+        if first >= last:
+            return []
+        first_ray = int(first / wall_width)
+        last_ray = int((last - 1) / wall_width) + 1
+
+        if numpy is not None:
+            depth = numpy.full(last_ray - first_ray, numpy.inf)
+            known = numpy.asarray(depth_buffer[first_ray:last_ray], dtype=float)
+            depth[:len(known)] = known
+            visible = numpy.concatenate(([False], depth > self.distance, [False]))
+            edges = numpy.flatnonzero(visible[1:] != visible[:-1])
+            rays = zip(edges[::2] + first_ray, edges[1::2] + first_ray)
+        else:
+            rays = []
+            run_start = None
+            for ray in range(first_ray, last_ray + 1):
+                visible = ray < last_ray and (ray >= len(depth_buffer) or depth_buffer[ray] > self.distance)
+                if visible and run_start == None:
+                    run_start = ray
+                elif not visible and run_start != None:
+                    rays.append((run_start, ray))
+                    run_start = None
+
+        return [(max(first, int(start) * wall_width), min(last, int(end) * wall_width)) for start, end in rays]
 
     def update_pos(self, pos):
         self.rect.centerx = pos[0]
         self.rect.centery = pos[1]
+        projection.moved(self)
             
 
 
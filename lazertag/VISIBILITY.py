@@ -0,0 +1,156 @@
+#Line of sight on a grid of opacity flags. Used by NPC.detect_player.
+
+import SETTINGS
+import MAP
+
+try:
+    import numpy
+except ImportError:
+    #Without numpy the batched check does one line at a time
+    numpy = None
+
+class Visibility:
+    '''== Line of sight service ==\nopaque[row][column] is True where sight is blocked. Doors update it when they open or close.'''
+    def __init__(self):
+        self.opaque = []
+        self.opaque_array = None
+        self.see_through = set()
+        #(start, end, render) -> bool. Cleared when a door changes or a new level is loaded.
+        self.memo = {}
+        self.checks = 0
+        self.memo_hits = 0
+        MAP.solid_listeners.append(self.tile_changed)
+
+    def build(self):
+        '''== Make the opacity grid for the current level ==\nNeeds SETTINGS.walkable_area'''
+        #Sight passes through the walkable area (open doors included) and sprite tiles. Everything else blocks it.
+        self.see_through = {id(tile) for tile in SETTINGS.walkable_area}
+        self.see_through.update(id(tile) for tile in SETTINGS.all_solid_tiles if tile.type == 'sprite')
+        self.opaque = [[self.blocks(tile) for tile in row] for row in SETTINGS.tile_grid]
+        if numpy:
+            columns = max(len(row) for row in self.opaque)
+            self.opaque_array = numpy.ones((len(self.opaque), columns), dtype=bool)
+            for row, flags in enumerate(self.opaque):
+                self.opaque_array[row, :len(flags)] = flags
+        self.memo.clear()
+
+    def blocks(self, tile):
+        if id(tile) not in self.see_through:
+            return True
+        if SETTINGS.tile_visible[tile.ID]:
+            if tile.type != 'hdoor' and tile.type != 'vdoor':
+                return True
+            return tile.solid
+        return False
+
+    def tile_changed(self, tile):
+        #Listener for MAP.solid_listeners
+        row, column = tile.map_pos[1], tile.map_pos[0]
+        if row < len(self.opaque) and column < len(self.opaque[row]) and SETTINGS.tile_grid[row][column] is tile:
+            self.opaque[row][column] = self.blocks(tile)
+            if self.opaque_array is not None:
+                self.opaque_array[row, column] = self.opaque[row][column]
+            self.memo.clear()
+
+    def is_opaque(self, column, row):
+        if row < 0 or column < 0 or row >= len(self.opaque) or column >= len(self.opaque[row]):
+            return True
+        return self.opaque[row][column]
+
+    def line_of_sight(self, start, end):
+        '''== Can start see end? ==\nline_of_sight(start, end) -> boolean. Positions are [column, row].'''
+        self.checks += 1
+        key = (start[0], start[1], end[0], end[1], SETTINGS.render)
+        if key in self.memo:
+            self.memo_hits += 1
+            return self.memo[key]
+
+        #DDA Algorithm
+        x1,y1 = start[0], start[1]
+        x2,y2 = end[0], end[1]
+
+        #If the coords are negative, start from the end instead
+        if x1 > x2 or (x1 == x2 and y1 > y2):
+            x1,y1,x2,y2 = x2,y2,x1,y1
+
+        x,y = x1, y1
+        dx = abs(x2-x1)
+        dy = abs(y2-y1)
+        length = dx if dx > dy else dy
+        #Make sure, you won't divide by 0
+        if length == 0:
+            length = 0.001
+
+        xinc = (x2-x1)/float(length)
+        yinc = (y2-y1)/float(length)
+
+        visible = False
+        for i in range(int(length)):
+            if i > SETTINGS.render:
+                break
+            x += xinc
+            y += yinc
+            mapx = int(x + 0.5)
+            mapy = int(y + 0.5)
+
+            if self.is_opaque(mapx, mapy):
+                break
+            if mapx == x2 and mapy == y2:
+                visible = True
+                break
+
+        if len(self.memo) > 20000:
+            self.memo.clear()
+        self.memo[key] = visible
+        return visible
+
+    def player_visible(self, npcs):
+        '''== Line of sight from every NPC to the player in one go ==\nplayer_visible(npcs) -> [boolean] in the same order'''
+        end = SETTINGS.player_map_pos
+        if numpy is None or self.opaque_array is None or not npcs:
+            return [self.line_of_sight(npc.map_pos, end) for npc in npcs]
+
+        #Same walk as line_of_sight for all lines at once. cumsum adds the steps in order, like x += xinc does.
+        start = numpy.array([npc.map_pos for npc in npcs], dtype=float).reshape(-1, 2)
+        swap = (start[:, 0] > end[0]) | ((start[:, 0] == end[0]) & (start[:, 1] > end[1]))
+        x1 = numpy.where(swap, end[0], start[:, 0])
+        y1 = numpy.where(swap, end[1], start[:, 1])
+        x2 = numpy.where(swap, start[:, 0], end[0])
+        y2 = numpy.where(swap, start[:, 1], end[1])
+        length = numpy.maximum(numpy.abs(x2 - x1), numpy.abs(y2 - y1))
+        divisor = numpy.where(length == 0, 0.001, length)
+        xinc = (x2 - x1) / divisor
+        yinc = (y2 - y1) / divisor
+
+        steps = int(min(length.max(), SETTINGS.render + 1)) if len(length) else 0
+        if steps == 0:
+            visible = numpy.zeros(len(npcs), dtype=bool)
+        else:
+            x = numpy.cumsum(numpy.hstack([x1[:, None], numpy.repeat(xinc[:, None], steps, axis=1)]), axis=1)[:, 1:]
+            y = numpy.cumsum(numpy.hstack([y1[:, None], numpy.repeat(yinc[:, None], steps, axis=1)]), axis=1)[:, 1:]
+            mapx = numpy.floor(x + 0.5).astype(numpy.int64)
+            mapy = numpy.floor(y + 0.5).astype(numpy.int64)
+            in_line = numpy.arange(steps)[None, :] < length[:, None]
+
+            rows, columns = self.opaque_array.shape
+            inside = (mapx >= 0) & (mapy >= 0) & (mapx < columns) & (mapy < rows)
+            blocked = numpy.ones(mapx.shape, dtype=bool)
+            blocked[inside] = self.opaque_array[mapy[inside], mapx[inside]]
+            reached = (mapx == x2[:, None]) & (mapy == y2[:, None]) & ~blocked
+
+            #Seen if the end is reached before anything blocks the line
+            stop = in_line & (blocked | reached)
+            first = numpy.argmax(stop, axis=1)
+            visible = stop.any(axis=1) & reached[numpy.arange(len(npcs)), first]
+
+        results = visible.tolist()
+        for npc, result in zip(npcs, results):
+            self.memo[(npc.map_pos[0], npc.map_pos[1], end[0], end[1], SETTINGS.render)] = result
+        return results
+
+    def memo_hit_rate(self):
+        if self.checks == 0:
+            return 0
+        return self.memo_hits / self.checks
+
+service = Visibility()
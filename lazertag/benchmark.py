@@ -0,0 +1,265 @@
+#Performance benchmarks. Runs headless on the first arena.
+#python benchmark.py strips [max threads] [rays]
+#python benchmark.py collision [max npcs]
+#python benchmark.py pathfinding [searches]
+#python benchmark.py jps [searches]
+
+import os
+import sys
+import time
+import random
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import MAIN
+import SETTINGS
+import MAP
+import PLAYER
+import RAYCAST
+import INVENTORY
+import HUD
+import TEXT
+import LASERTAG_ARENA
+import NPC
+import COLLISION
+import PATHFINDING
+
+
+def setup():
+    #Same setup as MAIN, without the menu and music
+    MAIN.gameLoad = MAIN.Load()
+    MAIN.gameLoad.load_resources()
+    MAIN.gameLoad.load_entities()
+    MAIN.gameLoad.load_custom_levels()
+    LASERTAG_ARENA.load_laser_tag_arenas()
+    MAIN.gameLoad.get_canvas_size()
+
+    MAIN.text = TEXT.Text(0,0,"YOU  WON", SETTINGS.WHITE, "DUGAFONT.ttf", 48)
+    MAIN.gameMap = MAP.Map(SETTINGS.levels_list[SETTINGS.current_level].array)
+    MAIN.gameCanvas = MAIN.Canvas(SETTINGS.canvas_map_width, SETTINGS.canvas_map_height)
+    SETTINGS.game_canvas = MAIN.gameCanvas
+    MAIN.gamePlayer = PLAYER.Player(SETTINGS.player_pos)
+    MAIN.gameRaycast = RAYCAST.Raycast(MAIN.gameCanvas.canvas, MAIN.gameCanvas.render_surface)
+    SETTINGS.current_gun = SETTINGS.gun_list[0]
+    SETTINGS.inventory['primary'] = SETTINGS.gun_list[0]
+    SETTINGS.inventory['melee'] = SETTINGS.gun_list[1]
+    SETTINGS.held_ammo = {'bullet': 0, 'shell': 0, 'ferromag': 0}
+    SETTINGS.max_ammo = {'bullet': 0, 'shell': 0, 'ferromag': 0}
+    MAIN.gameInv = INVENTORY.inventory({})
+    MAIN.gameHUD = HUD.hud()
+    MAIN.gameLoad.load_new_level()
+
+def time_frames(frames):
+    #Average ms for casting and drawing one 3D frame, turning a little every frame
+    start = time.perf_counter()
+    for frame in range(frames):
+        SETTINGS.player_angle = (frame * 7) % 360
+        MAIN.gameRaycast.calculate()
+        MAIN.gameCanvas.draw()
+        MAIN.render_screen(MAIN.gameCanvas.canvas)
+    return (time.perf_counter() - start) / frames * 1000
+
+def strips(max_threads, rays, frames=30):
+    '''== Strip rendering scaling curve ==\nstrips(max_threads, rays) -> ms per frame for 1 to max_threads strips'''
+    SETTINGS.resolution = rays
+    MAIN.gameRaycast = RAYCAST.Raycast(MAIN.gameCanvas.canvas, MAIN.gameCanvas.render_surface)
+    print("Strip rendering, %s rays, %s cores" % (rays, os.cpu_count()))
+    time_frames(5)
+    single = None
+    for threads in range(1, max_threads + 1):
+        SETTINGS.render_strips = threads
+        ms = time_frames(frames)
+        if not single:
+            single = ms
+        print("%2d threads: %6.2f ms/frame  x%.2f" % (threads, ms, single / ms))
+    SETTINGS.render_strips = 1
+
+def collision(max_npcs, rounds=20):
+    '''== Collision query cost against entity count ==\nThe old list scan of every solid tile and NPC against the spatial hash'''
+    random.seed(0)
+    templates = list(SETTINGS.npc_list)
+    walkable = [tile for tile in SETTINGS.walkable_area if tile.type not in ('hdoor', 'vdoor') and tile in SETTINGS.all_tiles[:-1]]
+    print("Collision queries, %s solid tiles" % len(SETTINGS.all_solid_tiles))
+    count = len(SETTINGS.npc_list)
+    while count <= max_npcs:
+        while len(SETTINGS.npc_list) < count:
+            template = random.choice(templates)
+            stats = dict(template.stats)
+            stats['pos'] = list(random.choice(walkable).map_pos)
+            SETTINGS.npc_list.append(NPC.Npc(stats, template.sounds, template.texture_path, team=template.team))
+
+        start = time.perf_counter()
+        for i in range(rounds):
+            for npc in SETTINGS.npc_list:
+                collide_list = SETTINGS.all_solid_tiles + SETTINGS.npc_list[:npc.order] + [SETTINGS.player]
+                hits = [s for s in collide_list if npc.rect.colliderect(s)]
+        scan = (time.perf_counter() - start) / rounds * 1000
+
+        start = time.perf_counter()
+        for i in range(rounds):
+            for npc in SETTINGS.npc_list:
+                hits = [s for s in COLLISION.world.query(npc.rect, npc) if s.type != 'npc' or s.order < npc.order]
+        grid = (time.perf_counter() - start) / rounds * 1000
+
+        print("%4d NPCs: list %7.2f ms  grid %6.2f ms  x%.1f" % (count, scan, grid, scan / grid))
+        count *= 2
+
+def load_array(array):
+    #Load a level array into the map like MAIN.Load.load_new_level does, without the entities
+    SETTINGS.all_tiles = []
+    SETTINGS.all_doors = []
+    SETTINGS.door_grid = {}
+    SETTINGS.all_solid_tiles = []
+    SETTINGS.trigger_tiles = []
+    MAIN.gameMap.__init__(array)
+
+def open_level(size, seed):
+    '''== Large generated level ==\nopen_level(size, seed) -> array. Rooms of 8x8 with gaps in their walls and some pillars.'''
+    rng = random.Random(seed)
+    array = [[0] * size for row in range(size)]
+    for row in range(size):
+        for column in range(size):
+            if row in (0, size-1) or column in (0, size-1):
+                array[row][column] = 1
+            elif (row % 8 == 0 or column % 8 == 0) and rng.random() < 0.8:
+                array[row][column] = 1
+            elif rng.random() < 0.05:
+                array[row][column] = 1
+    return array
+
+def open_arena(size, seed):
+    '''== Large open level ==\nopen_arena(size, seed) -> array. Open floor with short wall pieces, like the laser tag arenas.'''
+    rng = random.Random(seed)
+    array = [[0] * size for row in range(size)]
+    for row in range(size):
+        for column in range(size):
+            if row in (0, size-1) or column in (0, size-1):
+                array[row][column] = 1
+            elif rng.random() < 0.03:
+                #Two or three tiles of wall, across or down
+                for i in range(rng.randint(2, 3)):
+                    if rng.random() < 0.5:
+                        array[row][min(column + i, size-1)] = 11
+                    else:
+                        array[min(row + i, size-1)][column] = 11
+    return array
+
+def old_pathfind(start, end):
+    #The A* this tree used before, kept to compare with. Only the search, no error handling.
+    openlist = {}
+    closedlist = {}
+    path = []
+    max(SETTINGS.all_tiles, key=lambda x: x.map_pos)
+    max(SETTINGS.all_tiles, key=lambda x: x.map_pos)
+    start_point = [x for x in SETTINGS.all_tiles if x.map_pos == start][0]
+    end_point = [x for x in SETTINGS.all_tiles if x.map_pos == end][0]
+
+    def h_value(point):
+        return abs(point.map_pos[0] + point.map_pos[1] - end_point.map_pos[0] - end_point.map_pos[1])
+
+    openlist[start_point] = [0, h_value(start_point), h_value(start_point), None]
+    current_point = start_point
+    while current_point != end_point:
+        if not openlist:
+            return closedlist
+        current_point = min(openlist, key=lambda k: (openlist[k][2], openlist[k][1]))
+        closedlist[current_point] = openlist[current_point]
+        del openlist[current_point]
+
+        column, row = current_point.map_pos
+        adjacent = []
+        for position in ([column, row-1], [column+1, row], [column, row+1], [column-1, row]):
+            adj = [x for x in SETTINGS.all_tiles if x.map_pos == position]
+            if adj:
+                adjacent.append(adj[0])
+        for adj in adjacent:
+            if (adj.type == 'hdoor' or adj.type == 'vdoor' or not SETTINGS.tile_solid[adj.ID]) and adj not in closedlist:
+                if (adj in openlist and openlist[adj][0] > closedlist[current_point][0]+1) or adj not in openlist:
+                    openlist[adj] = [closedlist[current_point][0]+1, h_value(adj), closedlist[current_point][0]+1+h_value(adj), current_point]
+
+    while closedlist[current_point][3] != None:
+        path.append(current_point)
+        current_point = closedlist[current_point][3]
+    path.append(start_point)
+    return list(reversed(path))
+
+def pathfinding(searches):
+    '''== Old and new A* ==\nRandom searches on the arena and on large generated levels'''
+    levels = [('arena', SETTINGS.levels_list[SETTINGS.current_level].array)]
+    levels += [('open %sx%s' % (size, size), open_level(size, size)) for size in (32, 48, 64)]
+    print("A* pathfinding, %s random searches per level" % searches)
+    for name, array in levels:
+        load_array(array)
+        rng = random.Random(1)
+        walkable = [tile.map_pos for tile in SETTINGS.all_tiles[:-1] if not SETTINGS.tile_solid[tile.ID]]
+        pairs = [(rng.choice(walkable), rng.choice(walkable)) for i in range(searches)]
+        PATHFINDING.pathfind(pairs[0][0], pairs[0][1])
+
+        start = time.perf_counter()
+        new_paths = [PATHFINDING.pathfind(a, b) for a, b in pairs]
+        new = (time.perf_counter() - start) / searches * 1000
+
+        #The old one gets slow fast, so it only does as many as it can in a few seconds
+        start = time.perf_counter()
+        old_paths = []
+        for a, b in pairs:
+            old_paths.append(old_pathfind(a, b))
+            if time.perf_counter() - start > 5:
+                break
+        old = (time.perf_counter() - start) / len(old_paths) * 1000
+
+        same = sum(1 for x, y in zip(old_paths, new_paths) if type(x) == type(y) and len(x) == len(y))
+        print("%-12s old %8.2f ms  new %6.3f ms  x%.0f  same length %s/%s" % (name, old, new, old / new, same, len(old_paths)))
+    load_array(SETTINGS.levels_list[SETTINGS.current_level].array)
+
+def jps(searches):
+    '''== A* against jump point search ==\nExpanded nodes and time on the arena, the custom levels and large open levels'''
+    levels = [('arena', SETTINGS.levels_list[SETTINGS.current_level].array)]
+    levels += [('custom %s' % getattr(level, 'name', i), level.array) for i, level in enumerate(SETTINGS.clevels_list)]
+    levels += [('open %sx%s' % (size, size), open_arena(size, size)) for size in (32, 64, 128, 256)]
+    grid = PATHFINDING.nav_grid
+    print("A* and jump point search, %s random searches per level" % searches)
+    for name, array in levels:
+        load_array(array)
+        grid.update()
+        rng = random.Random(1)
+        walkable = [tile for tile in SETTINGS.all_tiles[:-1] if grid.walkable[tile.map_pos[1] * grid.width + tile.map_pos[0]]]
+        if len(walkable) < 2:
+            continue
+        pairs = [(rng.choice(walkable), rng.choice(walkable)) for i in range(searches)]
+
+        results = []
+        for search in (grid.search, grid.jump_search):
+            grid.expanded = 0
+            start = time.perf_counter()
+            for a, b in pairs:
+                search(a, b)
+            results.append(((time.perf_counter() - start) / searches * 1000, grid.expanded / searches))
+        (astar_ms, astar_nodes), (jps_ms, jps_nodes) = results
+        print("%-18s A* %7.1f nodes %7.3f ms   JPS %6.1f nodes %7.3f ms   nodes x%.1f  time x%.1f" % (
+            name, astar_nodes, astar_ms, jps_nodes, jps_ms, astar_nodes / max(jps_nodes, 1), astar_ms / jps_ms))
+    load_array(SETTINGS.levels_list[SETTINGS.current_level].array)
+
+
+if __name__ == '__main__':
+    if not RAYCAST.numpy:
+        print("Benchmarks need numpy")
+        sys.exit(1)
+    setup()
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'strips'
+    if benchmark == 'strips':
+        max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+        rays = int(sys.argv[3]) if len(sys.argv) > 3 else 1280
+        strips(max_threads, rays)
+    elif benchmark == 'collision':
+        max_npcs = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+        collision(max_npcs)
+    elif benchmark == 'pathfinding':
+        searches = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        pathfinding(searches)
+    elif benchmark == 'jps':
+        searches = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        jps(searches)
+    else:
+        print("Unknown benchmark: %s" % benchmark)
@@ -0,0 +1,100 @@
+#Checks the numpy batch caster against the per-ray caster.
+#Run from the lazertag folder: python -m pytest tests
+
+import os
+import sys
+import math
+import random
+import types
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import pygame
+import SETTINGS
+import RAYCAST
+
+if RAYCAST.numpy is None:
+    pytest.skip('the batch caster needs numpy', allow_module_level=True)
+
+#0 = floor, 1 = wall, 2 = hdoor, 3 = vdoor
+LEVEL = [
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1],
+    [1, 0, 0, 0, 3, 0, 0, 1, 0, 0, 0, 1],
+    [1, 0, 1, 0, 1, 0, 0, 1, 1, 2, 1, 1],
+    [1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1],
+    [1, 1, 2, 1, 1, 1, 0, 1, 0, 1, 0, 1],
+    [1, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 1],
+    [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    ]
+TYPES = {0: 'floor', 1: 'wall', 2: 'hdoor', 3: 'vdoor'}
+
+
+class Caster(RAYCAST.Raycast):
+    #Keeps what cast() found instead of rendering it
+    def control(self, end_pos, ray_number, tile_len, player_rect, texture, offset, current_tile, vh):
+        self.hits.append((tile_len, int(offset), current_tile, vh))
+
+
+@pytest.fixture
+def level(monkeypatch):
+    size = SETTINGS.tile_size
+    grid = []
+    for row, line in enumerate(LEVEL):
+        grid.append([])
+        for column, ID in enumerate(line):
+            grid[row].append(types.SimpleNamespace(ID=ID, type=TYPES[ID], open=0, map_pos=[column, row],
+                                                   rect=pygame.Rect(column * size, row * size, size, size)))
+    monkeypatch.setattr(SETTINGS, 'tile_grid', grid)
+    monkeypatch.setattr(SETTINGS, 'tile_visible', {0: False, 1: True, 2: True, 3: True})
+    monkeypatch.setattr(SETTINGS, 'tile_texture', {ID: None for ID in TYPES})
+    monkeypatch.setattr(SETTINGS, 'player_rect', pygame.Rect(0, 0, 16, 16))
+    monkeypatch.setattr(SETTINGS, 'resolution', 160)
+    return grid
+
+
+def compare(caster, grid, views):
+    size = SETTINGS.tile_size
+    floor = [tile for row in grid for tile in row if tile.ID == 0]
+    doors = [tile for row in grid for tile in row if tile.ID in (2, 3)]
+    mismatches = 0
+    for view in range(views):
+        for door in doors:
+            door.open = random.choice([0, 0, random.randint(0, size), size])
+        tile = random.choice(floor)
+        SETTINGS.player_rect.center = (tile.rect.x + random.randint(1, size - 1), tile.rect.y + random.randint(1, size - 1))
+        SETTINGS.player_angle = random.uniform(0, 360)
+
+        degrees, betas = caster.ray_angles()
+        caster.hits = []
+        for degree in degrees:
+            caster.cast(SETTINGS.player_rect, degree, 0)
+        batch = caster.cast_batch(degrees, betas)
+
+        for ray, (distance, offset, tile, vh) in enumerate(caster.hits):
+            tile_index = batch['tile'][ray]
+            if tile is None:
+                mismatches += tile_index >= 0
+            elif (tile_index < 0 or caster.grid_tiles[tile_index] is not tile
+                  or not math.isclose(distance, batch['distance'][ray], rel_tol=1e-9)
+                  or offset != batch['offset'][ray] or (vh == 'v') != batch['vh'][ray]):
+                mismatches += 1
+    return mismatches
+
+
+def test_cast_batch_matches_cast(level):
+    random.seed(2)
+    caster = Caster(None, None)
+    assert compare(caster, level, 200) == 0
+
+
+def test_cast_batch_follows_door_changes(level):
+    random.seed(3)
+    caster = Caster(None, None)
+    #The grid arrays are made once, door openings must still be picked up every cast
+    caster.update_grid()
+    assert compare(caster, level, 100) == 0